@@ -1,13 +1,121 @@
 #!/usr/bin/env python3
 
 import argparse
+import gc
+import multiprocessing
 
+import celery
 import gunicorn.app.base
 
+import yolocloud.admission
 import yolocloud.web
 
-def main():
-    pass
+class Application(gunicorn.app.base.BaseApplication):
+    def __init__(self, application, options=None):
+        self.application = application
+        self.options = options or {}
+        gunicorn.app.base.BaseApplication.__init__(self)
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+        self.cfg.set("post_fork", self.post_fork)
+
+    def load(self):
+        return self.application
+
+    def run(self):
+        # Templates are compiled once in the master; freezing the heap
+        # afterwards keeps the garbage collector from touching (and thereby
+        # copying) those pages in every worker
+        self.application.preload()
+        gc.collect()
+        gc.freeze()
+        gunicorn.app.base.BaseApplication.run(self)
+
+    def post_fork(self, server, worker):
+        self.application.after_fork()
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description="YoloCloud web server")
+    argparser.add_argument("--bind", default=None, dest="bind",
+            action="append", help="Address to listen on, may be given multiple times")
+    argparser.add_argument("--workers", type=int,
+            default=multiprocessing.cpu_count() * 2 + 1, dest="workers",
+            help="Number of worker processes, /metrics only covers the one answering")
+    argparser.add_argument("--worker-class", default="gthread",
+            dest="worker_class", help="gunicorn worker class")
+    argparser.add_argument("--threads", type=int, default=16, dest="threads",
+            help="Request threads per worker, a quarter of them may serve event streams")
+    argparser.add_argument("--timeout", type=int, default=60, dest="timeout",
+            help="Seconds after which a silent worker is restarted")
+    argparser.add_argument("--keepalive", type=int, default=5, dest="keepalive",
+            help="Seconds to wait for requests on a keep-alive connection")
+    argparser.add_argument("--max-requests", type=int, default=0,
+            dest="max_requests",
+            help="Restart workers after this many requests, 0 to disable")
+    argparser.add_argument("--engine", default="sqlite:///yolocloud.db",
+            dest="engine", help="Database engine URI")
+    argparser.add_argument("--broker", default="pyamqp://", dest="broker",
+            help="Celery broker URI")
+    argparser.add_argument("--backend", default=None, dest="backend",
+            help="Celery result backend URI, needed for bulk action reports")
+    argparser.add_argument("--vm-host", type=str, action="append",
+            dest="vm_hosts", metavar="URL=ADDRESS",
+            help="libvirt URL and the address its VNC servers listen on")
+    argparser.add_argument("--placement-policy", default="least-loaded",
+            dest="placement_policy", help="Host placement policy")
+    argparser.add_argument("--require-token", action="store_true",
+            dest="require_token", help="Only create machines for valid tokens")
+    argparser.add_argument("--admin-token", default=None, dest="admin_token",
+            help="Bearer token which permits listing all machines")
+    argparser.add_argument("--client-rate", type=float, default=2,
+            dest="client_rate", help="Creation requests per minute and client")
+    argparser.add_argument("--client-burst", type=int, default=3,
+            dest="client_burst", help="Creation requests a client may send at once")
+    argparser.add_argument("--token-rate", type=float, default=1,
+            dest="token_rate", help="Creation requests per minute and token")
+    argparser.add_argument("--token-burst", type=int, default=5,
+            dest="token_burst", help="Creation requests a token may send at once")
+    argparser.add_argument("--max-in-flight", type=int, default=50,
+            dest="max_in_flight",
+            help="Machines which may be provisioned at the same time")
+    argparser.add_argument("--trusted-proxies", type=int, default=0,
+            dest="trusted_proxies",
+            help="Reverse proxies in front of the server which append to X-Forwarded-For")
+
+    args = argparser.parse_args(argv)
+
+    vm_hosts = None
+    if args.vm_hosts:
+        vm_hosts = dict(vm_host.split("=", 1) for vm_host in args.vm_hosts)
+
+    wsgi_app = yolocloud.web.VMController(vm_hosts=vm_hosts,
+            require_token=args.require_token, admin_token=args.admin_token,
+            placement_policy=args.placement_policy, engine=args.engine,
+            celery_app=celery.Celery("yolocloud", broker=args.broker,
+                backend=args.backend),
+            admission_control=yolocloud.admission.AdmissionControl(
+                client_rate=args.client_rate / 60,
+                client_burst=args.client_burst,
+                token_rate=args.token_rate / 60,
+                token_burst=args.token_burst,
+                max_in_flight=args.max_in_flight),
+            trusted_proxies=args.trusted_proxies,
+            max_event_streams=max(1, args.threads // 4))
+
+    Application(wsgi_app, {
+        "bind": args.bind or ["[::]:8080"],
+        "workers": args.workers,
+        "worker_class": args.worker_class,
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "keepalive": args.keepalive,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        "preload_app": True,
+    }).run()
 
 if __name__ == "__main__":
-    pass
+    main()
@@ -0,0 +1,60 @@
+# coding: utf-8
+
+import collections
+import math
+import threading
+import time
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        # rate is in requests per second, burst the number of requests
+        # which may arrive at once after a quiet period
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, amount=1):
+        # Returns 0 if the request was admitted, otherwise the number of
+        # seconds until it would be
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if amount <= tokens:
+                tokens -= amount
+                wait = 0
+            elif amount > self.burst:
+                wait = math.inf
+            else:
+                wait = (amount - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            # Buckets which weren't used for long are full again anyway, so
+            # the least recently used ones can be forgotten
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+class AdmissionControl(object):
+    def __init__(self, token_rate=1/60, token_burst=5, client_rate=1/30,
+            client_burst=3, max_in_flight=50):
+        # The request counters live in the memory of the web process, so
+        # they cost no database round trip; with several server processes
+        # every one of them enforces the limits on its own. Machines being
+        # provisioned are counted in the database and so for everybody.
+        self.tokens = TokenBucket(token_rate, token_burst)
+        self.clients = TokenBucket(client_rate, client_burst)
+        self.max_in_flight = max_in_flight
+
+    def admit(self, client, token=None, amount=1):
+        wait = self.clients.take(client, amount)
+        if not wait and token:
+            wait = self.tokens.take(token, amount)
+        return wait
+
+    def provisioning_slots(self, in_flight, amount=1):
+        # A batch larger than the cap may start once the cap is free, it
+        # would never fit otherwise
+        return in_flight + min(amount, self.max_in_flight) <= self.max_in_flight
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import werkzeug.test
+
+import yolocloud.admission as admission
+import yolocloud.database as database
+import yolocloud.scheduler as scheduler
+import yolocloud.tasks as tasks
+import yolocloud.virt as virt
+import yolocloud.web as web
+
+libvirt_url = "test:///default"
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[int(round(p * (len(samples) - 1)))]
+
+def measure(name, f, iterations):
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        f(i)
+        samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    return dict(name=name, iterations=iterations,
+            throughput=iterations / elapsed,
+            p50=percentile(samples, 0.5),
+            p99=percentile(samples, 0.99))
+
+class Benchmark(object):
+    def __init__(self, directory, iterations=100):
+        self.iterations = iterations
+        # The test driver knows neither KVM domains nor the default pool,
+        # and has no bridges to attach interfaces to
+        self.template = virt.BaseVMTemplate(domain_type="test",
+                storage_pool="default-pool", with_network=False, hdd=64)
+        self.engine = database.create_engine("sqlite:///{}".format(
+            os.path.join(directory, "bench.db")))
+
+        tasks.Session.configure(bind=self.engine)
+        tasks.vm_templates["bench"] = self.template
+        tasks.app.conf.task_always_eager = True
+        tasks.app.conf.task_eager_propagates = True
+
+        self.app = web.VMController(engine=self.engine,
+                celery_app=tasks.app,
+                vm_hosts={libvirt_url: "::1"},
+                vm_templates={"bench": self.template},
+                connections=tasks.connections,
+                host_scheduler=scheduler.HostScheduler([libvirt_url],
+                    connections=tasks.connections,
+                    storage_pool="default-pool"),
+                # Every request comes from the same address, the limits
+                # would turn the benchmark away after a few of them
+                admission_control=admission.AdmissionControl(
+                    client_burst=10**9, token_burst=10**9,
+                    max_in_flight=10**9))
+        self.client = werkzeug.test.Client(self.app)
+        self.uuids = []
+
+    def create_vm(self, i):
+        response = self.client.post("/", data=dict(template="bench", token=""))
+        assert response.status_code in (302, 303), response.status
+        self.uuids.append(response.headers["Location"].rsplit("/", 1)[-1])
+
+    def show_vm(self, i):
+        response = self.client.get("/{}".format(self.uuids[i % len(self.uuids)]))
+        assert response.status_code == 200, response.status
+
+    def power_action(self, i):
+        # Every pass over the machines flips their power state
+        action = "start" if (i // len(self.uuids)) % 2 == 0 else "force-shutdown"
+        response = self.client.post("/{}".format(self.uuids[i % len(self.uuids)]),
+                data=dict(action=action))
+        assert response.status_code in (302, 303), response.status
+
+    def provision(self, i):
+        with tasks.connections.connection(libvirt_url) as vir_conn:
+            self.template.provision(database.VirtualMachine(
+                uuid=str(uuid.uuid4()),
+                management_password=database.generate_password()), vir_conn)
+
+    def parse_description(self, cold):
+        with tasks.connections.connection(libvirt_url) as vir_conn:
+            xml_descs = [vir_conn.lookupByUUIDString(uuid).XMLDesc()
+                    for uuid in self.uuids]
+        def parse(i):
+            if cold:
+                virt.DomainSummary._cache.clear()
+            desc = virt.DomainDescription(None,
+                    xml_desc=xml_descs[i % len(xml_descs)])
+            desc.memory, desc.vcpus, desc.has_cdrom
+            desc.remote_management_uri("::1")
+        return parse
+
+    def run(self):
+        n = self.iterations
+        results = [measure("create_vm", self.create_vm, n),
+            measure("show_vm", self.show_vm, n),
+            measure("power_action", self.power_action, n),
+            measure("BaseVMTemplate.provision", self.provision, n),
+            measure("DomainDescription (cold)", self.parse_description(True), n),
+            measure("DomainDescription (memoized)",
+                self.parse_description(False), n)]
+        return results
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description="YoloCloud benchmarks "
+            "against the libvirt test driver")
+    argparser.add_argument("--iterations", type=int, default=100,
+            dest="iterations", help="Iterations per benchmark")
+    argparser.add_argument("--json", action="store_true", dest="json",
+            help="Print the results as JSON")
+    args = argparser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = Benchmark(directory, iterations=args.iterations).run()
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print("{:<32} {:>12} {:>10} {:>10}".format("benchmark", "ops/s",
+        "p50 (ms)", "p99 (ms)"))
+    for result in results:
+        print("{name:<32} {throughput:>12.1f} {p50_ms:>10.3f} {p99_ms:>10.3f}".format(
+            p50_ms=result["p50"] * 1000, p99_ms=result["p99"] * 1000, **result))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,280 @@
+# coding: utf-8
+
+import abc
+import collections
+import threading
+import time
+
+import libvirt
+
+import yolocloud.database as database
+import yolocloud.virt as virt
+
+DomainState = collections.namedtuple("DomainState", ["info", "description"])
+Media = collections.namedtuple("Media", ["name", "capacity"])
+TokenInfo = collections.namedtuple("TokenInfo", ["token", "expires_at",
+    "vm_lifetime", "regenerates", "libvirt_url"])
+
+_event_loop_lock = threading.Lock()
+_event_loop_registered = False
+_event_loop_thread = None
+
+def start_event_loop():
+    global _event_loop_registered, _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is not None and _event_loop_thread.is_alive():
+            return
+        # The default implementation must be registered before the first
+        # connection is opened and only once per process, but the thread
+        # driving it does not survive a fork
+        if not _event_loop_registered:
+            libvirt.virEventRegisterDefaultImpl()
+            _event_loop_registered = True
+        _event_loop_thread = threading.Thread(target=_run_event_loop,
+                name="libvirt-event-loop", daemon=True)
+        _event_loop_thread.start()
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+class EventDrivenCache(abc.ABC):
+    def __init__(self, opener=None, keepalive=(5, 3), retry_interval=30):
+        self.opener = opener or libvirt.openReadOnly
+        self.keepalive = keepalive
+        # Hosts whose event connection failed aren't tried again for this
+        # many seconds, everything is queried live in the meantime
+        self.retry_interval = retry_interval
+        self._watched = {}
+        self._connecting = set()
+        self._retry_at = {}
+        self._lock = threading.RLock()
+
+    def watch(self, url):
+        with self._lock:
+            if url in self._watched:
+                return True
+            if url in self._connecting or \
+                    self._retry_at.get(url, 0) > time.monotonic():
+                return False
+            self._connecting.add(url)
+        # The handshake happens outside the lock, lookups of other hosts
+        # don't wait for it
+        try:
+            start_event_loop()
+            vir_conn = self.opener(url)
+            vir_conn.setKeepAlive(*self.keepalive)
+            vir_conn.registerCloseCallback(self._on_close, url)
+            self._register(url, vir_conn)
+        except libvirt.libvirtError:
+            with self._lock:
+                self._connecting.discard(url)
+                self._retry_at[url] = time.monotonic() + self.retry_interval
+            return False
+        with self._lock:
+            self._connecting.discard(url)
+            self._retry_at.pop(url, None)
+            self._watched[url] = vir_conn
+        return True
+
+    def is_watched(self, url):
+        return url in self._watched
+
+    def reset(self):
+        with self._lock:
+            self._watched.clear()
+            self._connecting.clear()
+            self._retry_at.clear()
+            self.clear()
+
+    def _on_close(self, vir_conn, reason, url):
+        # Without an event connection we can't tell whether cached entries
+        # are still current, so forget everything about the host
+        with self._lock:
+            if self._watched.get(url) is vir_conn:
+                del self._watched[url]
+            self.invalidate_host(url)
+
+    @abc.abstractmethod
+    def _register(self, url, vir_conn):
+        pass
+
+    @abc.abstractmethod
+    def invalidate_host(self, url):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+class DomainStateCache(EventDrivenCache):
+    # Lifecycle events have a handler of their own, all of these just make
+    # the cached state get fetched again
+    domain_events = [getattr(libvirt, name) for name in (
+        "VIR_DOMAIN_EVENT_ID_REBOOT",
+        "VIR_DOMAIN_EVENT_ID_TRAY_CHANGE",
+        "VIR_DOMAIN_EVENT_ID_DEVICE_ADDED",
+        "VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED",
+        "VIR_DOMAIN_EVENT_ID_METADATA_CHANGE")
+        if hasattr(libvirt, name)]
+
+    def __init__(self, *args, **kwargs):
+        EventDrivenCache.__init__(self, *args, **kwargs)
+        self._entries = {}
+
+    def lookup(self, url, uuid):
+        if not self.is_watched(url):
+            return None
+        return self._entries.get((url, uuid))
+
+    def store(self, url, uuid, info, xml_desc):
+        state = DomainState(info, virt.DomainDescription(None, xml_desc=xml_desc))
+        if self.watch(url):
+            with self._lock:
+                self._entries[(url, uuid)] = state
+        return state
+
+    def invalidate(self, url, uuid):
+        with self._lock:
+            self._entries.pop((url, uuid), None)
+
+    def invalidate_host(self, url):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == url]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _register(self, url, vir_conn):
+        vir_conn.domainEventRegisterAny(None,
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._on_lifecycle_event, url)
+        for event_id in self.domain_events:
+            vir_conn.domainEventRegisterAny(None, event_id,
+                    self._on_domain_event, url)
+
+    def _on_lifecycle_event(self, vir_conn, vir_dom, event, detail, url):
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.invalidate(url, vir_dom.UUIDString())
+        else:
+            self._refresh(url, vir_dom)
+
+    def _on_domain_event(self, vir_conn, vir_dom, *args):
+        # The callback signatures differ between event types, but the opaque
+        # value (our libvirt URL) is always passed last
+        self._refresh(args[-1], vir_dom)
+
+    def _refresh(self, url, vir_dom):
+        uuid = vir_dom.UUIDString()
+        if (url, uuid) not in self._entries:
+            return
+        try:
+            self.store(url, uuid, vir_dom.info(), vir_dom.XMLDesc())
+        except libvirt.libvirtError:
+            self.invalidate(url, uuid)
+
+class MediaCatalogue(EventDrivenCache):
+    pool_events = [getattr(libvirt, name) for name in (
+        "VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE",
+        "VIR_STORAGE_POOL_EVENT_ID_REFRESH")
+        if hasattr(libvirt, name)]
+
+    def __init__(self, *args, connections=None, ttl=60, **kwargs):
+        EventDrivenCache.__init__(self, *args, **kwargs)
+        self.connections = connections or virt.ConnectionPool()
+        self.ttl = ttl
+        self._entries = {}
+
+    def cached(self, url, pool_name):
+        entry = self._entries.get((url, pool_name))
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def volumes(self, url, pool_name):
+        medias = self.cached(url, pool_name)
+        if medias is not None:
+            return medias
+        # Uploads into a pool don't generate events, so the TTL still applies
+        # to watched hosts; events merely make changes show up earlier
+        self.watch(url)
+        with self.connections.connection(url) as vir_conn:
+            medias = self._fetch(vir_conn, pool_name)
+        with self._lock:
+            self._entries[(url, pool_name)] = (time.monotonic() + self.ttl,
+                    medias)
+        return medias
+
+    def contains(self, url, pool_name, name):
+        return any(media.name == name for media in self.volumes(url, pool_name))
+
+    def invalidate(self, url, pool_name):
+        with self._lock:
+            self._entries.pop((url, pool_name), None)
+
+    def invalidate_host(self, url):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == url]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _fetch(self, vir_conn, pool_name):
+        try:
+            vir_pool = vir_conn.storagePoolLookupByName(pool_name)
+        except libvirt.libvirtError:
+            return ()
+        # Volume names are part of the objects returned by listAllVolumes,
+        # only the capacities need an extra call per volume
+        return tuple(sorted((Media(vir_vol.name(), vir_vol.info()[1])
+            for vir_vol in vir_pool.listAllVolumes()),
+            key=lambda media: media.name))
+
+    def _register(self, url, vir_conn):
+        for event_id in self.pool_events:
+            vir_conn.storagePoolEventRegisterAny(None, event_id,
+                    self._on_pool_event, url)
+
+    def _on_pool_event(self, vir_conn, vir_pool, *args):
+        self.invalidate(args[-1], vir_pool.name())
+
+class TokenCache(object):
+    def __init__(self, ttl=30, max_size=10000):
+        # Regenerating tokens are validated from here for up to ttl seconds;
+        # single use tokens still have to be consumed in the database
+        self.ttl = ttl
+        self.max_size = max_size
+        self._tokens = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, session, token):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is not None and now - entry[1] < self.ttl:
+                return entry[0]
+        row = session.get(database.Token, token)
+        info = None
+        if row is not None:
+            info = TokenInfo(row.token, row.expires_at, row.vm_lifetime,
+                    row.regenerates, row.libvirt_url)
+        # Unknown tokens are remembered as well, so guessing doesn't cost a
+        # query per attempt
+        with self._lock:
+            self._tokens[token] = (info, now)
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+        return info
+
+    def invalidate(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
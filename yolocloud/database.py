@@ -1,8 +1,16 @@
 # coding: utf-8
 
-from sqlalchemy import Column, String, Integer, DateTime, Boolean
+from sqlalchemy import Column, String, Integer, DateTime, Boolean, Text
+from sqlalchemy import event, func, inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import column_property
 
+import sqlalchemy
+import sqlalchemy.orm
+
+import collections
+import json
 import random
 import uuid
 import datetime
@@ -22,18 +30,37 @@ class VirtualMachine(Base):
             primary_key=True,
             nullable=False)
     created_at = Column(DateTime,
-            default=datetime.datetime.now(),
+            default=datetime.datetime.now,
             nullable=False)
-    libvirt_url = Column(String,
+    # The fleet counters need the previous host and state on every change,
+    # even if they weren't loaded before
+    libvirt_url = column_property(Column(String,
             default="qemu:///system",
-            nullable=False)
-    expires_at = Column(DateTime)
+            nullable=False,
+            index=True), active_history=True)
+    expires_at = Column(DateTime,
+            index=True)
     management_password = Column(String,
             default=generate_password,
             nullable=True)
-    provisioned = Column(Boolean,
-            default=False)
+    provisioned = column_property(Column(Boolean,
+            default=False,
+            index=True), active_history=True)
+    provisioning_phase = column_property(Column(String,
+            default="queued"), active_history=True)
+    provisioning_progress = Column(Integer,
+            default=0)
     primary_disk = Column(String)
+    template = Column(String)
+    # Machines of the warm pool are provisioned ahead of time and are only
+    # handed out to users once they got claimed
+    assigned = Column(Boolean,
+            default=True,
+            nullable=False)
+    # Deleted machines are gone for users right away, the row is only kept
+    # until the domain got torn down
+    deleted_at = Column(DateTime,
+            index=True)
 
 class Token(Base):
     __tablename__ = "tokens"
@@ -47,3 +74,357 @@ class Token(Base):
     regenerates = Column(Boolean, default=False)
     libvirt_url = Column(String)
 
+
+class FleetCounter(Base):
+    __tablename__ = "fleet_counters"
+    # Number of machines per host and state, kept up to date on every
+    # change so the statistics don't have to count the whole table
+    libvirt_url = Column(String,
+            primary_key=True,
+            nullable=False)
+    state = Column(String,
+            primary_key=True,
+            nullable=False)
+    count = Column(Integer,
+            default=0,
+            nullable=False)
+
+class PendingAction(Base):
+    __tablename__ = "pending_actions"
+    # One row per machine with its queue of actions as JSON list of
+    # [action, arguments] pairs; see submit_vm_action for which submissions
+    # replace each other
+    uuid = Column(String(length=36),
+            primary_key=True,
+            nullable=False)
+    actions = Column(Text)
+    sequence = Column(Integer,
+            default=0,
+            nullable=False)
+    running = Column(Boolean,
+            default=False,
+            nullable=False)
+    updated_at = Column(DateTime)
+
+sqlite_pragmas = (
+    # Readers don't block the writer and vice versa, which matters as soon
+    # as the web server and the Celery workers share the file
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", 5000),
+    ("temp_store", "MEMORY"),
+    ("cache_size", -16384),
+    ("foreign_keys", "ON"),
+)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in sqlite_pragmas:
+            cursor.execute("PRAGMA {}={}".format(pragma, value))
+    finally:
+        cursor.close()
+
+def create_engine(url, create_tables=True, **kwargs):
+    if url.startswith("sqlite"):
+        engine = sqlalchemy.create_engine(url, **kwargs)
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    else:
+        kwargs.setdefault("pool_pre_ping", True)
+        kwargs.setdefault("pool_recycle", 3600)
+        engine = sqlalchemy.create_engine(url, **kwargs)
+    if create_tables:
+        create_all(engine)
+    return engine
+
+def create_all(engine):
+    counted = inspect(engine).has_table(FleetCounter.__tablename__)
+    Base.metadata.create_all(engine)
+    upgrade_tables(engine)
+    if not counted:
+        with sqlalchemy.orm.Session(bind=engine) as session:
+            rebuild_fleet_counters(session)
+
+def upgrade_tables(engine):
+    # create_all() skips tables which exist already, so columns and indexes
+    # added since a database was created are added here. Existing rows get
+    # the default of the column, which has to be a constant for that.
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"]
+                    for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = str(sqlalchemy.schema.CreateColumn(column).compile(
+                    dialect=engine.dialect))
+                if column.default is not None and column.default.is_scalar:
+                    ddl += " DEFAULT " + str(sqlalchemy.literal(
+                        column.default.arg, column.type).compile(
+                            dialect=engine.dialect,
+                            compile_kwargs=dict(literal_binds=True)))
+                elif not column.nullable:
+                    raise RuntimeError("Column {}.{} is missing and can't be "
+                            "added to the existing rows, please upgrade the "
+                            "database by hand".format(table.name, column.name))
+                connection.execute(sqlalchemy.text("ALTER TABLE {} ADD COLUMN {}"
+                    .format(table.name, ddl)))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+def lookup_vm(session, uuid, deleted=False):
+    # Primary key lookups hit the identity map first and otherwise use a
+    # statement which is compiled once and then cached
+    vm = session.get(VirtualMachine, uuid)
+    if vm is not None and vm.deleted_at is not None and not deleted:
+        return None
+    return vm
+
+def create_tokens(session, count, **values):
+    # One multi-row INSERT in a single transaction, no matter how many
+    # tokens get issued
+    tokens = [dict(values, token=str(uuid.uuid4())) for i in range(count)]
+    session.execute(Token.__table__.insert(), tokens)
+    session.commit()
+    return tokens
+
+def consume_token(session, token):
+    # Only one of several concurrent requests can delete the row, which is
+    # what makes a single use token single use
+    return session.query(Token).filter(Token.token == token,
+            Token.regenerates == False).delete(synchronize_session=False) == 1
+
+def mark_deleted(session, uuids, now=None):
+    return session.query(VirtualMachine).filter(
+            VirtualMachine.uuid.in_(uuids),
+            VirtualMachine.deleted_at == None).update(
+                    dict(deleted_at=now or datetime.datetime.now()),
+                    synchronize_session="fetch")
+
+def fleet_state(provisioned, phase=None):
+    # Failed machines are kept apart, they don't take up any provisioning
+    # capacity anymore
+    if provisioned:
+        return "provisioned"
+    return "failed" if phase == "failed" else "provisioning"
+
+def _count_fleet(connection, libvirt_url, state, delta):
+    table = FleetCounter.__table__
+    updated = connection.execute(table.update().where(
+        table.c.libvirt_url == libvirt_url,
+        table.c.state == state).values(count=table.c.count + delta))
+    if not updated.rowcount:
+        connection.execute(table.insert().values(libvirt_url=libvirt_url,
+            state=state, count=delta))
+
+@event.listens_for(VirtualMachine, "after_insert")
+def _count_inserted_vm(mapper, connection, target):
+    _count_fleet(connection, target.libvirt_url,
+            fleet_state(target.provisioned, target.provisioning_phase), 1)
+
+@event.listens_for(VirtualMachine, "after_delete")
+def _count_deleted_vm(mapper, connection, target):
+    _count_fleet(connection, target.libvirt_url,
+            fleet_state(target.provisioned, target.provisioning_phase), -1)
+
+@event.listens_for(VirtualMachine, "after_update")
+def _count_updated_vm(mapper, connection, target):
+    attrs = inspect(target).attrs
+    def previous(attr):
+        history = attr.history
+        return history.deleted[0] if history.deleted else attr.value
+    old = (previous(attrs.libvirt_url), fleet_state(previous(attrs.provisioned),
+        previous(attrs.provisioning_phase)))
+    new = (target.libvirt_url, fleet_state(target.provisioned,
+        target.provisioning_phase))
+    if old != new:
+        _count_fleet(connection, *old, -1)
+        _count_fleet(connection, *new, 1)
+
+def rebuild_fleet_counters(session):
+    session.query(FleetCounter).delete()
+    rows = session.query(VirtualMachine.libvirt_url,
+            VirtualMachine.provisioned, VirtualMachine.provisioning_phase,
+            func.count()).group_by(VirtualMachine.libvirt_url,
+                    VirtualMachine.provisioned,
+                    VirtualMachine.provisioning_phase)
+    counts = collections.Counter()
+    for libvirt_url, provisioned, phase, count in rows:
+        counts[libvirt_url, fleet_state(provisioned, phase)] += count
+    session.add_all(FleetCounter(libvirt_url=libvirt_url, state=state,
+        count=count) for (libvirt_url, state), count in counts.items())
+    session.commit()
+
+def fleet_counts(session):
+    return {(counter.libvirt_url, counter.state): counter.count
+            for counter in session.query(FleetCounter)
+            if counter.count}
+
+def provisioning_count(session):
+    # Shared by all server processes, unlike anything kept in memory
+    return session.query(func.coalesce(func.sum(FleetCounter.count), 0)).filter(
+            FleetCounter.state == "provisioning").scalar()
+
+def delete_vms(session, uuids):
+    # Bulk deletes bypass the mapper events, so the counters are adjusted
+    # here within the same transaction
+    rows = session.query(VirtualMachine.libvirt_url,
+            VirtualMachine.provisioned, VirtualMachine.provisioning_phase,
+            func.count()).filter(VirtualMachine.uuid.in_(uuids)).group_by(
+                    VirtualMachine.libvirt_url,
+                    VirtualMachine.provisioned,
+                    VirtualMachine.provisioning_phase).all()
+    deleted = session.query(VirtualMachine).filter(
+            VirtualMachine.uuid.in_(uuids)).delete(synchronize_session=False)
+    session.query(PendingAction).filter(PendingAction.uuid.in_(uuids)).delete(
+            synchronize_session=False)
+    connection = session.connection()
+    for libvirt_url, provisioned, phase, count in rows:
+        _count_fleet(connection, libvirt_url, fleet_state(provisioned, phase),
+                -count)
+    return deleted
+
+# Claims of workers which didn't report back for this long are considered
+# dead, so a crashed worker can't block a machine forever
+action_claim_timeout = datetime.timedelta(minutes=10)
+
+def _action_is_running(row, now):
+    return row.running and row.updated_at is not None and \
+            now - row.updated_at < action_claim_timeout
+
+# Power actions only express the state the user wants the machine to be in,
+# so one replaces another queued right before it. Everything else runs in
+# the order it was submitted.
+coalescing_actions = frozenset(["start", "shutdown", "reboot", "reset",
+    "force-shutdown"])
+max_pending_actions = 8
+
+def _action_kind(action):
+    return "power" if action in coalescing_actions else action
+
+def _queue_action(actions, action, arguments):
+    actions = list(actions)
+    if actions and action in coalescing_actions and \
+            _action_kind(actions[-1][0]) == "power":
+        actions[-1] = [action, arguments]
+    elif actions and action == "change_media" and \
+            actions[-1][0] == "change_media":
+        actions[-1] = [action, arguments]
+    else:
+        actions.append([action, arguments])
+    if len(actions) > max_pending_actions:
+        raise ValueError("Too many actions pending")
+    return actions
+
+def submit_vm_action(session, uuid, action, arguments=None, attempts=5):
+    # Raises ValueError if the machine has too many actions queued already
+    arguments = arguments or {}
+    for attempt in range(attempts):
+        now = datetime.datetime.now()
+        row = session.query(PendingAction).filter(
+                PendingAction.uuid == uuid).first()
+        if row is None:
+            session.add(PendingAction(uuid=uuid,
+                actions=json.dumps([[action, arguments]]), sequence=1,
+                updated_at=now))
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                continue
+            return True
+        # A new worker is only needed if nobody will pick up the action:
+        # neither a running worker, which checks the sequence number after
+        # each action, nor a queued task (actions set). A task which hasn't
+        # claimed its action within the claim timeout is taken as lost.
+        running = _action_is_running(row, now)
+        waiting = row.actions is not None and row.updated_at is not None and \
+                now - row.updated_at < action_claim_timeout
+        needs_worker = not running and not waiting
+        sequence = row.sequence
+        actions = _queue_action(json.loads(row.actions or "[]"), action,
+                arguments)
+        values = dict(actions=json.dumps(actions), sequence=sequence + 1)
+        if not running:
+            # The claim time of a running worker is kept, so a stuck one
+            # still times out
+            values["updated_at"] = now
+        updated = session.query(PendingAction).filter(
+                PendingAction.uuid == uuid,
+                PendingAction.sequence == sequence).update(values,
+                    synchronize_session=False)
+        session.commit()
+        if updated:
+            return needs_worker
+        session.expire_all()
+    return True
+
+def claim_vm_action(session, uuid, owned=False):
+    # With owned set, the caller already holds the slot of the machine from
+    # a previous claim and either gets the next action or gives up the slot
+    while True:
+        now = datetime.datetime.now()
+        session.expire_all()
+        row = session.query(PendingAction).filter(
+                PendingAction.uuid == uuid).first()
+        if row is None:
+            return None
+        if row.actions is None:
+            if not owned or release_vm_action(session, uuid, row.sequence):
+                return None
+            continue
+        if not owned and _action_is_running(row, now):
+            return None
+        (action, arguments), *remaining = json.loads(row.actions)
+        # The sequence changes with the queue, so a submission which read
+        # the queue before can't put the claimed action back
+        claimed = session.query(PendingAction).filter(
+                PendingAction.uuid == uuid,
+                PendingAction.sequence == row.sequence).update(dict(
+                    actions=json.dumps(remaining) if remaining else None,
+                    sequence=row.sequence + 1, running=True, updated_at=now),
+                    synchronize_session=False)
+        session.commit()
+        if claimed:
+            return (action, arguments)
+
+def release_vm_action(session, uuid, sequence):
+    # Only release the slot if no new action arrived in the meantime,
+    # otherwise the caller has to claim and run that one as well
+    released = session.query(PendingAction).filter(
+            PendingAction.uuid == uuid,
+            PendingAction.sequence == sequence).update(dict(running=False),
+                    synchronize_session=False)
+    session.commit()
+    return bool(released)
+
+def abandon_vm_action(session, uuid):
+    session.query(PendingAction).filter(PendingAction.uuid == uuid).update(
+            dict(running=False), synchronize_session=False)
+    session.commit()
+    return session.query(PendingAction).filter(PendingAction.uuid == uuid,
+            PendingAction.actions != None).count() > 0
+
+def claim_warm_vm(session, template, libvirt_url=None, attempts=5, **values):
+    query = session.query(VirtualMachine.uuid).filter(
+            VirtualMachine.template == template,
+            VirtualMachine.assigned == False,
+            VirtualMachine.provisioned == True,
+            VirtualMachine.deleted_at == None)
+    if libvirt_url:
+        query = query.filter(VirtualMachine.libvirt_url == libvirt_url)
+    for candidate, in query.limit(attempts).all():
+        # Conditional update, so concurrent requests can't claim the same
+        # machine twice
+        claimed = session.query(VirtualMachine).filter(
+                VirtualMachine.uuid == candidate,
+                VirtualMachine.assigned == False,
+                VirtualMachine.deleted_at == None).update(
+                        dict(assigned=True, **values),
+                        synchronize_session=False)
+        if claimed:
+            session.commit()
+            return session.query(VirtualMachine).filter(
+                    VirtualMachine.uuid == candidate).first()
+    return None
@@ -0,0 +1,97 @@
+# coding: utf-8
+
+import collections
+import contextlib
+import threading
+import time
+
+import yolocloud.database as database
+import yolocloud.virt as virt
+
+ProgressState = collections.namedtuple("ProgressState", ["provisioned",
+    "phase", "progress", "domain_state"])
+
+class ProgressBroadcaster(object):
+    def __init__(self, session_factory, domain_cache=None, interval=1):
+        self._Session = session_factory
+        self.domain_cache = domain_cache
+        self.interval = interval
+        self._watchers = collections.Counter()
+        self._states = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                    name="progress-broadcaster", daemon=True)
+            self._thread.start()
+
+    def reset(self):
+        with self._condition:
+            self._thread = None
+            self._watchers.clear()
+            self._states.clear()
+
+    @contextlib.contextmanager
+    def watch(self, uuid):
+        with self._condition:
+            self._watchers[uuid] += 1
+        self.start()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._watchers[uuid] -= 1
+                if self._watchers[uuid] <= 0:
+                    del self._watchers[uuid]
+                    self._states.pop(uuid, None)
+
+    def wait(self, uuid, previous, timeout):
+        with self._condition:
+            self._condition.wait_for(
+                    lambda: self._states.get(uuid, previous) != previous,
+                    timeout)
+            return self._states.get(uuid)
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # A failing poll must not kill the thread all streams
+                # depend on
+                pass
+            time.sleep(self.interval)
+
+    def poll(self):
+        with self._condition:
+            uuids = list(self._watchers)
+        if not uuids:
+            return
+        # One query per interval for all open streams, no matter how many
+        # clients are waiting
+        session = self._Session()
+        try:
+            rows = session.query(database.VirtualMachine.uuid,
+                    database.VirtualMachine.libvirt_url,
+                    database.VirtualMachine.provisioned,
+                    database.VirtualMachine.provisioning_phase,
+                    database.VirtualMachine.provisioning_progress).filter(
+                            database.VirtualMachine.uuid.in_(uuids)).all()
+        finally:
+            session.close()
+        states = {}
+        for uuid, libvirt_url, provisioned, phase, progress in rows:
+            domain_state = None
+            if provisioned and self.domain_cache is not None:
+                cached = self.domain_cache.lookup(libvirt_url, uuid)
+                if cached is not None:
+                    domain_state = virt.state_to_text_mapping.get(cached.info[0])
+            states[uuid] = ProgressState(bool(provisioned), phase,
+                    progress or 0, domain_state)
+        with self._condition:
+            self._states.update(states)
+            self._condition.notify_all()
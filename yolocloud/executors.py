@@ -0,0 +1,66 @@
+# coding: utf-8
+
+import concurrent.futures
+import threading
+
+class HostExecutors(object):
+    def __init__(self, max_workers=4, timeout=5):
+        # Every host gets its own bounded pool, so a hypervisor which stops
+        # answering only exhausts its own threads and not everybody's.
+        # Request threads wait for these calls, so the timeout stays far
+        # below the one after which the worker gets restarted.
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def executor(self, url):
+        with self._lock:
+            executor = self._executors.get(url)
+            if executor is None:
+                executor = self._executors[url] = \
+                        concurrent.futures.ThreadPoolExecutor(
+                                max_workers=self.max_workers,
+                                thread_name_prefix="host-{}".format(url))
+            return executor
+
+    def submit(self, url, fn, *args, **kwargs):
+        return self.executor(url).submit(fn, *args, **kwargs)
+
+    def call(self, url, fn, *args, **kwargs):
+        future = self.submit(url, fn, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            # Calls still waiting for a thread are dropped, so they don't
+            # pile up behind a hanging hypervisor
+            future.cancel()
+            raise
+
+    def fan_out(self, calls):
+        # calls maps arbitrary keys to (url, fn, args) tuples; the result
+        # maps the same keys to return values or raised exceptions
+        futures = {key: self.submit(url, fn, *args)
+                for key, (url, fn, args) in calls.items()}
+        # One deadline for all of them, not one per host
+        concurrent.futures.wait(futures.values(), self.timeout)
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result(0)
+            except Exception as e:
+                future.cancel()
+                results[key] = e
+        return results
+
+    def reset(self):
+        # Executor threads don't survive a fork, and the parent's executors
+        # must not be shut down from the child
+        with self._lock:
+            self._executors = {}
+
+    def shutdown(self):
+        with self._lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=False)
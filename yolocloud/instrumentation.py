@@ -0,0 +1,155 @@
+# coding: utf-8
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+        30, 60, 120)
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+        .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels) + "}"
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, registry=None):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is None:
+            registry = default_registry
+        if registry is not False:
+            registry.register(self)
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.extend(self._expose_value(labels, value))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _expose_value(self, labels, value):
+        yield "{}{} {}".format(self.name, _format_labels(labels), value)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=default_buckets, registry=None):
+        Metric.__init__(self, name, help, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        # Only the matching bucket is incremented, the cumulative counts are
+        # computed on exposition to keep observations cheap
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _expose_value(self, labels, state):
+        counts, total, count = state
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            yield "{}_bucket{} {}".format(self.name,
+                    _format_labels(labels + (("le", bound),)), cumulative)
+        yield "{}_sum{} {}".format(self.name, _format_labels(labels), total)
+        yield "{}_count{} {}".format(self.name, _format_labels(labels), count)
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def expose(self):
+        return "\n".join(metric.expose() for metric in self._metrics) + "\n"
+
+class BottlePlugin(object):
+    name = "instrumentation"
+    api = 2
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def apply(self, callback, route):
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            # Redirects and aborts are raised as exceptions, so they are
+            # measured as well
+            with self.histogram.time(method=route.method, route=route.rule):
+                return callback(*args, **kwargs)
+        return wrapper
+
+def serve(port, registry=None, host="::"):
+    import socket
+    import wsgiref.simple_server
+    if registry is None:
+        registry = default_registry
+
+    def application(environ, start_response):
+        start_response("200 OK", [("Content-Type", content_type)])
+        return [registry.expose().encode()]
+
+    class Server(wsgiref.simple_server.WSGIServer):
+        address_family = socket.AF_INET6 if ":" in host else socket.AF_INET
+
+    class Handler(wsgiref.simple_server.WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = wsgiref.simple_server.make_server(host, port, application,
+            server_class=Server, handler_class=Handler)
+    thread = threading.Thread(target=server.serve_forever,
+            name="metrics-server", daemon=True)
+    thread.start()
+    return server
+
+default_registry = Registry()
+
+libvirt_connect_seconds = Histogram("yolocloud_libvirt_connect_seconds",
+        "Time spent opening libvirt connections")
+provision_phase_seconds = Histogram("yolocloud_provision_phase_seconds",
+        "Time spent in the phases of machine provisioning")
+task_seconds = Histogram("yolocloud_task_seconds",
+        "Run time of Celery tasks")
+task_queue_delay_seconds = Histogram("yolocloud_task_queue_delay_seconds",
+        "Time between sending a Celery task and a worker starting it")
+task_failures_total = Counter("yolocloud_task_failures_total",
+        "Celery tasks which raised an exception")
+request_seconds = Histogram("yolocloud_request_seconds",
+        "Time spent handling web requests")
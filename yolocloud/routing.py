@@ -0,0 +1,61 @@
+# coding: utf-8
+
+import hashlib
+import re
+
+default_host_options = {
+    # Worker processes consuming the queue of a host
+    "concurrency": 4,
+    # Seconds an expiring task may wait in the queue before it gets discarded
+    "expires": 300,
+    "soft_time_limit": 60,
+    "time_limit": 90
+}
+
+# Only tasks which are queued again when they get lost may expire; anything
+# else would leave machines half provisioned or never deleted. A discarded
+# run_vm_actions is noticed by submit_vm_action after the claim timeout,
+# the reaper retries machines after the deletion grace period.
+expiring_tasks = frozenset([
+    "yolocloud.tasks.run_vm_actions",
+    "yolocloud.tasks.reap_host",
+])
+
+# Volume deletion runs on its own queue, consumed by few workers with a
+# low concurrency, so it never competes with the host queues
+reclaim_queue = "yolocloud.reclaim"
+
+def queue_name(libvirt_url):
+    # Queue names must stay readable in monitoring, but different URLs must
+    # never collapse into the same queue
+    readable = re.sub(r"[^A-Za-z0-9]+", "-", libvirt_url).strip("-")
+    digest = hashlib.sha1(libvirt_url.encode()).hexdigest()[:8]
+    return "yolocloud.host.{}.{}".format(readable, digest)
+
+class HostRouter(object):
+    def __init__(self, host_options=None, default_options=None):
+        self.host_options = host_options or {}
+        self.default_options = dict(default_host_options)
+        self.default_options.update(default_options or {})
+
+    def host_config(self, libvirt_url):
+        config = dict(self.default_options)
+        config.update(self.host_options.get(libvirt_url, {}))
+        return config
+
+    def options(self, libvirt_url, task=None):
+        if libvirt_url is None:
+            return {}
+        config = self.host_config(libvirt_url)
+        options = dict(queue=queue_name(libvirt_url),
+                soft_time_limit=config["soft_time_limit"],
+                time_limit=config["time_limit"])
+        if task in expiring_tasks:
+            options["expires"] = config["expires"]
+        return options
+
+    def worker_arguments(self, libvirt_url):
+        config = self.host_config(libvirt_url)
+        return ["-Q", queue_name(libvirt_url),
+                "--concurrency", str(config["concurrency"]),
+                "--hostname", "{}@%h".format(queue_name(libvirt_url))]
@@ -0,0 +1,126 @@
+# coding: utf-8
+
+import collections
+import random
+import threading
+import time
+
+import libvirt
+
+import yolocloud.executors as executors
+import yolocloud.virt as virt
+
+HostSnapshot = collections.namedtuple("HostSnapshot", ["url", "free_memory",
+    "total_memory", "committed_memory", "cpus", "active_domains",
+    "defined_domains", "free_storage", "taken_at"])
+
+Demand = collections.namedtuple("Demand", ["memory", "storage"])
+
+def demand_for(template):
+    memory = getattr(template, "memory", 0) * 1024 * 1024
+    storage = getattr(template, "hdd", 0) * 1024 * 1024
+    # Overlays on top of a golden image start out (almost) empty
+    if getattr(template, "base_image", None) is not None:
+        storage = 0
+    return Demand(memory, storage)
+
+class LeastLoadedPolicy(object):
+    def choose(self, snapshots, demand):
+        return max(snapshots, key=lambda s: s.free_memory)
+
+class BinPackingPolicy(object):
+    def choose(self, snapshots, demand):
+        return min(snapshots, key=lambda s: s.free_memory - demand.memory)
+
+class SpreadPolicy(object):
+    def choose(self, snapshots, demand):
+        return min(snapshots, key=lambda s: s.defined_domains / max(s.cpus, 1))
+
+policies = {
+    "least-loaded": LeastLoadedPolicy,
+    "bin-packing": BinPackingPolicy,
+    "spread": SpreadPolicy
+}
+
+class HostScheduler(object):
+    def __init__(self, hosts, connections=None, policy="least-loaded",
+            refresh_interval=30, storage_pool="default",
+            memory_reserve=512*1024*1024, host_executors=None):
+        self.hosts = list(hosts)
+        self.connections = connections or virt.ConnectionPool()
+        self.host_executors = host_executors or executors.HostExecutors()
+        if isinstance(policy, str):
+            policy = policies[policy]()
+        self.policy = policy
+        self.refresh_interval = refresh_interval
+        self.storage_pool = storage_pool
+        # Memory which is never handed out to guests, so the hypervisor
+        # itself doesn't run into swapping
+        self.memory_reserve = memory_reserve
+        self._snapshots = {}
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, url):
+        with self.connections.connection(url) as vir_conn:
+            info = vir_conn.getInfo()
+            try:
+                free_storage = vir_conn.storagePoolLookupByName(
+                        self.storage_pool).info()[3]
+            except libvirt.libvirtError:
+                free_storage = 0
+            # Shut off domains don't show up in the free memory of the host,
+            # but they may be started any time, so every defined domain is
+            # charged with its configured maximum
+            vir_doms = vir_conn.listAllDomains(0)
+            committed_memory = sum(vir_dom.info()[1] for vir_dom in vir_doms) * 1024
+            total_memory = info[1] * 1024 * 1024
+            active_domains = sum(1 for vir_dom in vir_doms if vir_dom.isActive())
+            return HostSnapshot(url=url,
+                    free_memory=min(vir_conn.getFreeMemory(),
+                        total_memory - committed_memory),
+                    total_memory=total_memory,
+                    committed_memory=committed_memory,
+                    cpus=info[2],
+                    active_domains=active_domains,
+                    defined_domains=len(vir_doms),
+                    free_storage=free_storage,
+                    taken_at=time.monotonic())
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and self._refreshed_at is not None and \
+                    time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return
+            results = self.host_executors.fan_out({url: (url, self.snapshot,
+                (url,)) for url in self.hosts})
+            # Unreachable hosts don't get any new machines until the next
+            # refresh
+            self._snapshots = {url: result for url, result in results.items()
+                    if isinstance(result, HostSnapshot)}
+            self._refreshed_at = time.monotonic()
+
+    def snapshots(self):
+        self.refresh()
+        return list(self._snapshots.values())
+
+    def pick(self, template=None):
+        self.refresh()
+        demand = demand_for(template)
+        with self._lock:
+            if not self._snapshots:
+                return random.choice(self.hosts)
+            candidates = [s for s in self._snapshots.values()
+                    if s.free_memory - self.memory_reserve >= demand.memory
+                    and s.free_storage >= demand.storage]
+            if not candidates:
+                return None
+            chosen = self.policy.choose(candidates, demand)
+            # Account for the placement until the next refresh, so a burst of
+            # requests doesn't pile up on the same host
+            self._snapshots[chosen.url] = chosen._replace(
+                    free_memory=chosen.free_memory - demand.memory,
+                    committed_memory=chosen.committed_memory + demand.memory,
+                    free_storage=chosen.free_storage - demand.storage,
+                    defined_domains=chosen.defined_domains + 1)
+            return chosen.url
@@ -0,0 +1,180 @@
+# coding: utf-8
+
+import array
+import threading
+import time
+
+import libvirt
+
+import yolocloud.executors as executors
+import yolocloud.virt as virt
+
+metrics = ("cpu.time", "balloon.current", "block.rd.bytes", "block.wr.bytes",
+        "net.rx.bytes", "net.tx.bytes")
+
+class RingBuffer(object):
+    __slots__ = ("values", "position", "count")
+
+    def __init__(self, capacity):
+        self.values = array.array("d", bytes(8 * capacity))
+        self.position = 0
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.position] = value
+        self.position = (self.position + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        start = (self.position - self.count) % len(self.values)
+        for i in range(self.count):
+            yield self.values[(start + i) % len(self.values)]
+
+    def last(self, n=1):
+        n = min(n, self.count)
+        return [self.values[(self.position - n + i) % len(self.values)]
+                for i in range(n)]
+
+class DomainSeries(object):
+    __slots__ = ("libvirt_url", "timestamps", "metrics")
+
+    def __init__(self, libvirt_url, capacity):
+        self.libvirt_url = libvirt_url
+        self.timestamps = RingBuffer(capacity)
+        self.metrics = {name: RingBuffer(capacity) for name in metrics}
+
+    def append(self, timestamp, sample):
+        self.timestamps.append(timestamp)
+        for name, buf in self.metrics.items():
+            buf.append(sample.get(name, 0))
+
+    def rates(self):
+        if len(self.timestamps) < 2:
+            return None
+        (t0, t1) = self.timestamps.last(2)
+        if t1 <= t0:
+            return None
+        rates = {}
+        for name, buf in self.metrics.items():
+            (before, after) = buf.last(2)
+            rates[name] = (after - before) / (t1 - t0)
+        return dict(cpu_percent=rates["cpu.time"] / 1e7,
+                memory=self.metrics["balloon.current"].last()[0] * 1024,
+                block_read=rates["block.rd.bytes"],
+                block_write=rates["block.wr.bytes"],
+                net_rx=rates["net.rx.bytes"],
+                net_tx=rates["net.tx.bytes"])
+
+    def as_dict(self):
+        return dict(host=self.libvirt_url,
+                timestamps=list(self.timestamps),
+                metrics={name: list(buf) for name, buf in self.metrics.items()})
+
+def summarize(stats):
+    sample = {
+        "cpu.time": stats.get("cpu.time", 0),
+        "balloon.current": stats.get("balloon.current", 0)
+    }
+    # Sum up the per-device counters, we only keep totals per domain
+    for prefix, fields in (("block", ("rd.bytes", "wr.bytes")),
+            ("net", ("rx.bytes", "tx.bytes"))):
+        for field in fields:
+            sample["{}.{}".format(prefix, field)] = sum(
+                    stats.get("{}.{}.{}".format(prefix, i, field), 0)
+                    for i in range(stats.get("{}.count".format(prefix), 0)))
+    return sample
+
+class StatsCollector(object):
+    stats_types = (libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+            libvirt.VIR_DOMAIN_STATS_BALLOON |
+            libvirt.VIR_DOMAIN_STATS_BLOCK |
+            libvirt.VIR_DOMAIN_STATS_INTERFACE)
+
+    def __init__(self, hosts, connections=None, interval=10, capacity=360,
+            host_executors=None):
+        self.hosts = list(hosts)
+        self.connections = connections or virt.ConnectionPool()
+        self.host_executors = host_executors or executors.HostExecutors()
+        self.interval = interval
+        self.capacity = capacity
+        self._series = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                    name="stats-collector", daemon=True)
+            self._thread.start()
+
+    def reset(self):
+        with self._lock:
+            self._thread = None
+            self._series = {}
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            self.collect()
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def collect(self):
+        # Hosts are sampled concurrently, so one slow hypervisor doesn't
+        # delay the samples of all others; failures are skipped until the
+        # next interval
+        self.host_executors.fan_out({url: (url, self.collect_host, (url,))
+            for url in self.hosts})
+
+    def collect_host(self, url):
+        with self.connections.connection(url) as vir_conn:
+            # One call for all domains of the host instead of several calls
+            # per domain
+            records = vir_conn.getAllDomainStats(self.stats_types)
+        timestamp = time.time()
+        seen = set()
+        with self._lock:
+            for vir_dom, stats in records:
+                uuid = vir_dom.UUIDString()
+                seen.add(uuid)
+                series = self._series.get(uuid)
+                if series is None:
+                    series = self._series[uuid] = DomainSeries(url,
+                            self.capacity)
+                series.append(timestamp, summarize(stats))
+            for uuid in [uuid for uuid, series in self._series.items()
+                    if series.libvirt_url == url and uuid not in seen]:
+                del self._series[uuid]
+
+    def series(self, uuid):
+        return self._series.get(uuid)
+
+    def overview(self):
+        with self._lock:
+            return {uuid: series.rates()
+                    for uuid, series in self._series.items()}
+
+    def host_overview(self):
+        # Totals per host, which reveal nothing about individual machines
+        hosts = {}
+        with self._lock:
+            for series in self._series.values():
+                rates = series.rates()
+                if rates is None:
+                    continue
+                totals = hosts.setdefault(series.libvirt_url,
+                        dict.fromkeys(rates, 0))
+                totals["domains"] = totals.get("domains", 0) + 1
+                for name, value in rates.items():
+                    totals[name] += value
+        return hosts
+
+    def as_dict(self, uuids=None):
+        with self._lock:
+            return {uuid: series.as_dict()
+                    for uuid, series in self._series.items()
+                    if uuids is None or uuid in uuids}
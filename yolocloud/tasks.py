@@ -1,27 +1,119 @@
 # coding: utf-8
 
+import collections
+import concurrent.futures
+import contextlib
+import datetime
 import functools
+import time
 
 import celery
+import celery.signals
 import libvirt
 import sqlalchemy
 import sqlalchemy.orm
-import jinja2
 import lxml.etree
 
+import yolocloud.cache as cache
 import yolocloud.database as database
+import yolocloud.instrumentation as instrumentation
+import yolocloud.routing as routing
+import yolocloud.templating as templating
 import yolocloud.virt as virt
 
 app = celery.Celery("yolocloud", broker="pyamqp://")
-engine = sqlalchemy.create_engine("sqlite:///yolocloud.db")
+engine = database.create_engine("sqlite:///yolocloud.db",
+        create_tables=False)
 Session = sqlalchemy.orm.sessionmaker(bind=engine)
 vm_templates = { "base": virt.BaseVMTemplate() }
+# (template, libvirt URL) -> number of unassigned machines to keep ready
+warm_pool_sizes = {}
+# Expired machines handled per reaper run; the teardown itself runs on the
+# queue of each host, in tasks small enough to finish within its time limit
+reaper_batch_size = 200
+reaper_chunk_size = 20
+# Deleted machines whose delete task got lost are reaped after this long
+deletion_grace_period = datetime.timedelta(minutes=10)
+# Volume deletions per reclaim worker; wiping overwrites the data first,
+# which is much more I/O than just deleting the volume
+reclaim_rate_limit = "30/m"
+wipe_volumes = False
+# Domain operations of a bulk power action which run at the same time
+bulk_action_concurrency = 8
+# libvirt URL -> overrides of routing.default_host_options
+host_options = {}
+host_router = routing.HostRouter(host_options)
+# If set, workers expose their metrics on this port; with the prefork pool
+# tasks run in child processes, so use the solo or threads pool for this
+metrics_port = None
+connections = virt.ConnectionPool()
+media_catalogue = cache.MediaCatalogue(connections=connections)
 
-jinja2_env = jinja2.Environment(loader=jinja2.PackageLoader("yolocloud", "templates"))
+app.conf.beat_schedule = {
+    "refill-warm-pools": {
+        "task": "yolocloud.tasks.refill_warm_pools",
+        "schedule": 60.0
+    },
+    "reap-expired-vms": {
+        "task": "yolocloud.tasks.reap_expired_vms",
+        "schedule": 60.0
+    }
+}
+
+jinja2_env = templating.environment("templates")
 
 def render_template(name, **kwargs):
     return jinja2_env.get_template(name).render(**kwargs)
 
+@celery.signals.worker_process_init.connect
+def reset_connections(**kwargs):
+    # libvirt connections must never be shared between forked worker
+    # processes, so every child starts with a fresh pool
+    connections.close()
+    media_catalogue.reset()
+
+@celery.signals.worker_init.connect
+def create_tables(**kwargs):
+    database.create_all(engine)
+
+@celery.signals.worker_init.connect
+def precompile_templates(**kwargs):
+    # Runs in the main process, so the pool processes inherit the compiled
+    # templates
+    templating.precompile(jinja2_env)
+    for vm_template in vm_templates.values():
+        vm_template.preload()
+    # Nothing opened in the main process may be used by the pool processes
+    engine.dispose()
+
+@celery.signals.worker_init.connect
+def serve_metrics(**kwargs):
+    if metrics_port is not None:
+        instrumentation.serve(metrics_port)
+
+_task_started = {}
+
+@celery.signals.task_prerun.connect
+def task_started(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    sent_at = getattr(task.request, "sent_at", None)
+    if sent_at is None:
+        sent_at = (task.request.headers or {}).get("sent_at")
+    if sent_at is not None:
+        instrumentation.task_queue_delay_seconds.observe(
+                max(0, time.time() - sent_at), task=task.name)
+
+@celery.signals.task_postrun.connect
+def task_finished(task_id=None, task=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        instrumentation.task_seconds.observe(time.perf_counter() - started,
+                task=task.name)
+
+@celery.signals.task_failure.connect
+def task_failed(sender=None, **kwargs):
+    instrumentation.task_failures_total.inc(task=sender.name)
+
 def with_database_session(f):
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
@@ -31,19 +123,32 @@ def with_database_session(f):
 @app.task
 def provision_vm(uuid, template, config={}):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     tpl = vm_templates[template]
+
+    def progress(phase, percent):
+        vm.provisioning_phase = phase
+        vm.provisioning_progress = percent
+        db.commit()
+
     try:
-        tpl.provision(vm, vir_conn)
-    finally:
-        vir_conn.close()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            tpl.provision(vm, vir_conn, progress=progress)
+            if tpl.snapshot:
+                with tpl.phase("snapshot", 90, progress):
+                    tpl.take_snapshot(vm, vir_conn)
+    except:
+        db.rollback()
+        progress("failed", 0)
+        db.close()
+        raise
     try:
         vm.provisioned = True
+        vm.provisioning_phase = "done"
+        vm.provisioning_progress = 100
         db.add(vm)
         db.commit()
     finally:
@@ -52,102 +157,414 @@ def provision_vm(uuid, template, config={}):
 @app.task
 def shutdown_vm(uuid):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     try:
-        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-        vir_dom.shutdown()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+            vir_dom.shutdown()
     finally:
-        vir_conn.close()
         db.close()
 
 @app.task
 def reboot_vm(uuid):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     try:
-        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-        vir_dom.reboot()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+            vir_dom.reboot()
     finally:
-        vir_conn.close()
         db.close()
 
 @app.task
 def start_vm(uuid):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     try:
-        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-        vir_dom.create()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+            vir_dom.create()
     finally:
-        vir_conn.close()
         db.close()
 
 @app.task
 def reset_vm(uuid):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     try:
-        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-        vir_dom.reset()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+            vir_dom.reset()
     finally:
-        vir_conn.close()
         db.close()
 
 @app.task
 def destroy_vm(uuid):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     try:
-        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-        vir_dom.destroy()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+            vir_dom.destroy()
+    finally:
+        db.close()
+
+def _vm_template(vm):
+    # Snapshots of machines whose template is gone can still be reverted,
+    # that only needs the domain
+    return vm_templates.get(vm.template) or virt.VirtualMachineTemplate()
+
+@app.task
+def snapshot_vm(uuid, mode=None):
+    db = Session()
+    vm = database.lookup_vm(db, uuid)
+    if not vm:
+        db.close()
+        return
+    try:
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            _vm_template(vm).take_snapshot(vm, vir_conn, mode)
     finally:
-        vir_conn.close()
         db.close()
 
+@app.task
+def revert_vm(uuid):
+    db = Session()
+    vm = database.lookup_vm(db, uuid)
+    if not vm:
+        db.close()
+        return
+    try:
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            return _vm_template(vm).revert_snapshot(vm, vir_conn)
+    finally:
+        db.close()
+
+def _change_media(vir_conn, vm, media_volume, media_pool="iso"):
+    if media_volume and not media_catalogue.contains(vm.libvirt_url,
+            media_pool, media_volume):
+        return
+    vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+    dom_desc = virt.DomainDescription(vir_dom)
+    if media_volume:
+        dom_desc.cdrom = (media_pool, media_volume)
+    else:
+        del dom_desc.cdrom
+    vir_dom.updateDeviceFlags(lxml.etree.tostring(dom_desc.cdrom_node).decode(),
+            flags=libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
 @app.task
 def change_media(uuid, media_volume, media_pool="iso"):
     db = Session()
-    vm = db.query(database.VirtualMachine).filter(
-            database.VirtualMachine.uuid == uuid).first()
+    vm = database.lookup_vm(db, uuid)
     if not vm:
         db.close()
         return
-    vir_conn = libvirt.open(vm.libvirt_url)
     try:
-        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-        dom_desc = virt.DomainDescription(vir_dom)
-        if media_volume:
-            dom_desc.cdrom = (media_pool, media_volume)
-        else:
-            del dom_desc.cdrom
-        vir_dom.updateDeviceFlags(lxml.etree.tostring(dom_desc.cdrom_node).decode(),
-                flags=libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            _change_media(vir_conn, vm, media_volume, media_pool)
     finally:
-        vir_conn.close()
         db.close()
 
+@app.task
+def refill_warm_pools():
+    db = Session()
+    try:
+        for (template, libvirt_url), size in warm_pool_sizes.items():
+            # Machines which are still being provisioned count as well,
+            # otherwise slow provisioning would overfill the pool; failed
+            # and deleted ones will never be handed out
+            available = db.query(database.VirtualMachine).filter(
+                    database.VirtualMachine.template == template,
+                    database.VirtualMachine.libvirt_url == libvirt_url,
+                    database.VirtualMachine.assigned == False,
+                    database.VirtualMachine.deleted_at == None,
+                    database.VirtualMachine.provisioning_phase.is_distinct_from(
+                        "failed")).count()
+            vms = [database.VirtualMachine(template=template,
+                libvirt_url=libvirt_url, assigned=False)
+                for i in range(size - available)]
+            if not vms:
+                continue
+            db.add_all(vms)
+            db.commit()
+            for vm in vms:
+                provision_vm.apply_async((vm.uuid, template),
+                        **host_router.options(libvirt_url))
+    finally:
+        db.close()
+
+def teardown_domain(vir_conn, uuid, keep_volumes=False):
+    try:
+        vir_dom = vir_conn.lookupByUUIDString(uuid)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            return ()
+        raise
+    # The frozen base volumes of snapshotted disks go after their overlays
+    disks = virt.DomainDescription(vir_dom).disks
+    disks += tuple((pool, volume[:-len(virt.overlay_suffix)])
+            for pool, volume in disks if volume.endswith(virt.overlay_suffix))
+    if vir_dom.isActive():
+        vir_dom.destroy()
+    vir_dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+            libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+    if not keep_volumes:
+        for pool, volume in disks:
+            _delete_volume(vir_conn, pool, volume)
+    return disks
+
+def _delete_volume(vir_conn, pool, volume, wipe=False):
+    try:
+        vir_vol = vir_conn.storagePoolLookupByName(pool).storageVolLookupByName(
+                volume)
+        if wipe:
+            vir_vol.wipe()
+        vir_vol.delete()
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+            raise
+
+@app.task(rate_limit=reclaim_rate_limit, ignore_result=True,
+        autoretry_for=(libvirt.libvirtError,), retry_backoff=True,
+        max_retries=5)
+def reclaim_volume(libvirt_url, pool, volume, wipe=None):
+    with connections.connection(libvirt_url) as vir_conn:
+        _delete_volume(vir_conn, pool, volume,
+                wipe_volumes if wipe is None else wipe)
+
+def _delete_domain(vir_conn, libvirt_url, uuid, keep_volumes=False):
+    # The domain goes right away, while its volumes are left to the
+    # throttled reclaim workers, so mass deletions don't saturate the
+    # storage the remaining machines run on
+    volumes = teardown_domain(vir_conn, uuid, keep_volumes=True)
+    if keep_volumes:
+        return
+    for pool, volume in volumes:
+        reclaim_volume.apply_async((libvirt_url, pool, volume),
+                queue=routing.reclaim_queue)
+
+@app.task
+def delete_vm(uuid, keep_volumes=False):
+    db = Session()
+    try:
+        vm = database.lookup_vm(db, uuid, deleted=True)
+        if not vm:
+            return
+        database.mark_deleted(db, [uuid])
+        db.commit()
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            _delete_domain(vir_conn, vm.libvirt_url, uuid, keep_volumes)
+        database.delete_vms(db, [uuid])
+        db.commit()
+    finally:
+        db.close()
+
+@app.task
+def reap_host(libvirt_url, uuids):
+    db = Session()
+    try:
+        reaped = []
+        try:
+            with connections.connection(libvirt_url) as vir_conn:
+                for uuid in uuids:
+                    try:
+                        _delete_domain(vir_conn, libvirt_url, uuid)
+                    except libvirt.libvirtError:
+                        continue
+                    reaped.append(uuid)
+        except libvirt.libvirtError:
+            # The host is unreachable, its machines are retried after the
+            # grace period
+            pass
+        if reaped:
+            database.delete_vms(db, reaped)
+            db.commit()
+    finally:
+        db.close()
+
+@app.task
+def reap_expired_vms():
+    db = Session()
+    try:
+        now = datetime.datetime.now()
+        # Fresh expirations and retries are picked separately, so machines
+        # on unreachable hosts can't crowd out the ones which just expired
+        expired = db.query(database.VirtualMachine.uuid,
+                database.VirtualMachine.libvirt_url).filter(
+                    database.VirtualMachine.deleted_at == None,
+                    database.VirtualMachine.expires_at <= now).order_by(
+                        database.VirtualMachine.expires_at).limit(
+                            reaper_batch_size).all()
+        retried = db.query(database.VirtualMachine.uuid,
+                database.VirtualMachine.libvirt_url).filter(
+                    database.VirtualMachine.deleted_at <=
+                        now - deletion_grace_period).order_by(
+                            database.VirtualMachine.deleted_at).limit(
+                                reaper_batch_size).all()
+        if expired:
+            # Users lose access right away, even if the host can't be
+            # reached at the moment
+            database.mark_deleted(db, [uuid for uuid, libvirt_url in expired],
+                    now)
+        if retried:
+            # Another grace period before the next attempt
+            db.query(database.VirtualMachine).filter(
+                    database.VirtualMachine.uuid.in_(
+                        [uuid for uuid, libvirt_url in retried])).update(
+                            dict(deleted_at=now), synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    hosts = collections.defaultdict(list)
+    for uuid, libvirt_url in expired + retried:
+        hosts[libvirt_url].append(uuid)
+    # Each host is torn down by its own workers under their time limits, so
+    # a hanging hypervisor only holds up its own machines
+    for libvirt_url, uuids in hosts.items():
+        for i in range(0, len(uuids), reaper_chunk_size):
+            reap_host.apply_async((libvirt_url, uuids[i:i + reaper_chunk_size]),
+                    **host_router.options(libvirt_url, task=reap_host.name))
+    # A full batch means that there are probably more expired machines left
+    if len(expired) == reaper_batch_size:
+        reap_expired_vms.delay()
+
+power_actions = {
+    "start": lambda vir_dom: vir_dom.create(),
+    "shutdown": lambda vir_dom: vir_dom.shutdown(),
+    "reboot": lambda vir_dom: vir_dom.reboot(),
+    "reset": lambda vir_dom: vir_dom.reset(),
+    "force-shutdown": lambda vir_dom: vir_dom.destroy()
+}
+
+@app.task
+def bulk_power_action(action, uuids=None, libvirt_url=None):
+    if action not in power_actions:
+        raise ValueError("Unknown power action {!r}".format(action))
+    if uuids is None and libvirt_url is None:
+        # Never act on the whole fleet by accident
+        raise ValueError("Neither machines nor libvirt URL given")
+    db = Session()
+    try:
+        # Machines marked for deletion and those still waiting in a warm
+        # pool belong to nobody who could have asked for this
+        query = db.query(database.VirtualMachine.uuid,
+                database.VirtualMachine.libvirt_url).filter(
+                        database.VirtualMachine.provisioned == True,
+                        database.VirtualMachine.assigned == True,
+                        database.VirtualMachine.deleted_at == None)
+        if uuids is not None:
+            query = query.filter(database.VirtualMachine.uuid.in_(uuids))
+        if libvirt_url is not None:
+            query = query.filter(database.VirtualMachine.libvirt_url == libvirt_url)
+        machines = query.all()
+    finally:
+        db.close()
+    results = {uuid: "not found" for uuid in uuids or ()}
+    hosts = collections.defaultdict(list)
+    for uuid, vm_url in machines:
+        hosts[vm_url].append(uuid)
+    futures = {}
+    with contextlib.ExitStack() as stack, \
+            concurrent.futures.ThreadPoolExecutor(
+                    max_workers=bulk_action_concurrency) as executor:
+        for vm_url, host_uuids in hosts.items():
+            try:
+                vir_conn = stack.enter_context(connections.connection(vm_url))
+            except libvirt.libvirtError as e:
+                results.update((uuid, str(e)) for uuid in host_uuids)
+                continue
+            for uuid in host_uuids:
+                futures[executor.submit(_bulk_power_action_vm, vir_conn, uuid,
+                    action)] = uuid
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = str(e)
+    return results
+
+def _bulk_power_action_vm(vir_conn, uuid, action):
+    # Goes through the action slot of the machine like any other action, so
+    # it neither overtakes nor races with the actions already queued
+    db = Session()
+    try:
+        vm = database.lookup_vm(db, uuid)
+        if not vm:
+            return "not found"
+        if not database.submit_vm_action(db, uuid, action):
+            return "queued"
+        claimed = database.claim_vm_action(db, uuid)
+        if claimed is None:
+            return "queued"
+        statuses = [status for ran, status
+                in _run_claimed_vm_actions(db, vir_conn, vm, claimed)
+                if ran in power_actions]
+        # The power action queued last is the one the machine ends up with
+        return statuses[-1] if statuses else "ok"
+    finally:
+        db.close()
+
+def _run_vm_action(vir_conn, vm, action, arguments):
+    if action == "change_media":
+        _change_media(vir_conn, vm, **arguments)
+    elif action == "revert":
+        _vm_template(vm).revert_snapshot(vm, vir_conn)
+    elif action in power_actions:
+        power_actions[action](vir_conn.lookupByUUIDString(vm.uuid))
+
+def _run_claimed_vm_actions(db, vir_conn, vm, claimed):
+    # Runs actions until the queue of the machine is empty and returns what
+    # became of each of them
+    results = []
+    try:
+        while claimed is not None:
+            action, arguments = claimed
+            try:
+                _run_vm_action(vir_conn, vm, action, arguments)
+                results.append((action, "ok"))
+            except libvirt.libvirtError as e:
+                # e.g. starting a running machine, this must not hold up
+                # the actions queued after it
+                results.append((action, str(e)))
+            claimed = database.claim_vm_action(db, vm.uuid, owned=True)
+    except:
+        db.rollback()
+        if database.abandon_vm_action(db, vm.uuid):
+            run_vm_actions.apply_async((vm.uuid,), countdown=5,
+                    **host_router.options(vm.libvirt_url,
+                        task=run_vm_actions.name))
+        raise
+    return results
+
+@app.task
+def run_vm_actions(uuid):
+    db = Session()
+    try:
+        vm = database.lookup_vm(db, uuid)
+        if not vm:
+            return
+        # Only one worker at a time holds the action slot of a machine;
+        # actions submitted meanwhile get picked up by the loop
+        claimed = database.claim_vm_action(db, uuid)
+        if claimed is None:
+            return
+        with connections.connection(vm.libvirt_url) as vir_conn:
+            _run_claimed_vm_actions(db, vir_conn, vm, claimed)
+    finally:
+        db.close()
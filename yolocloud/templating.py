@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import collections
+import os
+import stat
+import threading
+
+import jinja2
+
+# Compiled templates survive restarts and are shared by all processes of a
+# user, so neither the web server nor the Celery workers have to parse them
+# again after a deploy. Without a directory given, Jinja2 picks a private one
+# below the temporary directory and checks that nobody else owns it.
+bytecode_cache_directory = os.environ.get("YOLOCLOUD_JINJA2_CACHE")
+
+_environments = {}
+_environments_lock = threading.Lock()
+
+def bytecode_cache():
+    if bytecode_cache_directory is None:
+        return jinja2.FileSystemBytecodeCache()
+    # Loading bytecode executes it, so the directory must not be writable
+    # by anybody else
+    os.makedirs(bytecode_cache_directory, mode=0o700, exist_ok=True)
+    actual = os.lstat(bytecode_cache_directory)
+    if (not stat.S_ISDIR(actual.st_mode) or actual.st_uid != os.getuid()
+            or stat.S_IMODE(actual.st_mode) & 0o077):
+        raise RuntimeError("Jinja2 bytecode cache {} must be a directory only "
+                "accessible by its owner".format(bytecode_cache_directory))
+    return jinja2.FileSystemBytecodeCache(bytecode_cache_directory)
+
+def environment(path, package="yolocloud"):
+    # One environment per template directory, shared by everyone who
+    # renders from it, so every template is compiled once per process
+    with _environments_lock:
+        env = _environments.get((package, path))
+        if env is None:
+            env = _environments[package, path] = jinja2.Environment(
+                    loader=jinja2.PackageLoader(package, path),
+                    bytecode_cache=bytecode_cache(),
+                    auto_reload=False)
+        return env
+
+def precompile(env):
+    for name in env.list_templates():
+        env.get_template(name)
+
+class RenderCache(object):
+    def __init__(self, env, size=256):
+        # For pages which only depend on a few hashable values, such as the
+        # error pages, which are rendered with one of a handful of reasons
+        self.env = env
+        self.size = size
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, name, key=None, **kwargs):
+        if key is None:
+            key = (name, tuple(sorted(kwargs.items())))
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+        page = self.env.get_template(name).render(**kwargs)
+        with self._lock:
+            self._pages[key] = page
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
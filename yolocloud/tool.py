@@ -2,30 +2,113 @@
 # coding: utf-8
 
 import argparse
+import csv
+import datetime
+import sys
 
+import celery
 import libvirt
 import sqlalchemy
 import sqlalchemy.orm
 
 import yolocloud.database as database
+import yolocloud.routing as routing
 import yolocloud.virt as virt
 
 Session = sqlalchemy.orm.sessionmaker()
 
+token_fields = ("token", "expires_at", "vm_lifetime", "regenerates",
+        "libvirt_url")
+
 def main_create_token(args):
     session = Session()
-    token = database.Token(token=args.token, libvirt_url=args.libvirt_url,
-            regenerates=args.regenerate, vm_lifetime=args.vm_lifetime)
-    session.add(token)
-    session.commit()
-    print(token.token)
+    values = dict(libvirt_url=args.libvirt_url, regenerates=args.regenerate,
+            vm_lifetime=args.vm_lifetime, expires_at=None)
+    if args.valid_for:
+        values["expires_at"] = datetime.datetime.now() + datetime.timedelta(
+                seconds=args.valid_for)
+    if args.token is not None:
+        if args.count != 1:
+            raise SystemExit("A token string can only be given for a single token")
+        token = database.Token(token=args.token, **values)
+        session.add(token)
+        session.commit()
+        tokens = [dict(values, token=token.token)]
+    else:
+        tokens = database.create_tokens(session, args.count, **values)
+    if args.csv is None:
+        for token in tokens:
+            print(token["token"])
+        return
+    if args.csv == "-":
+        write_tokens_csv(sys.stdout, tokens)
+        return
+    with open(args.csv, "w", newline="") as f:
+        write_tokens_csv(f, tokens)
+
+def write_tokens_csv(f, tokens):
+    writer = csv.DictWriter(f, token_fields)
+    writer.writeheader()
+    writer.writerows(tokens)
 
 def main_create_domain(args):
     session = Session()
-    vm = database.VirtualMachine()
+    vms = [database.VirtualMachine(template=args.template)
+            for i in range(args.count)]
+    for i, vm in enumerate(vms):
+        if args.libvirt_urls:
+            vm.libvirt_url = args.libvirt_urls[i % len(args.libvirt_urls)]
+    session.add_all(vms)
+    session.commit()
+    if args.provision:
+        app = celery.Celery("yolocloud", broker=args.broker)
+        router = routing.HostRouter()
+        celery.group(app.signature("yolocloud.tasks.provision_vm",
+            kwargs=dict(uuid=vm.uuid, template=args.template),
+            **router.options(vm.libvirt_url))
+            for vm in vms).apply_async()
+    for vm in vms:
+        print(vm.uuid)
 
 def main_delete_domain(args):
-    pass
+    session = Session()
+    vms = session.query(database.VirtualMachine).filter(
+            database.VirtualMachine.uuid.in_(args.uuids),
+            database.VirtualMachine.deleted_at == None).all()
+    database.mark_deleted(session, [vm.uuid for vm in vms])
+    session.commit()
+    app = celery.Celery("yolocloud", broker=args.broker)
+    router = routing.HostRouter()
+    celery.group(app.signature("yolocloud.tasks.delete_vm",
+        kwargs=dict(uuid=vm.uuid, keep_volumes=args.keep_hdd),
+        **router.options(vm.libvirt_url))
+        for vm in vms).apply_async()
+    for vm in vms:
+        print(vm.uuid)
+
+def main_power_action(args):
+    if not args.uuids and args.libvirt_url is None:
+        raise SystemExit("Either domain UUIDs or --libvirt-url are required")
+    app = celery.Celery("yolocloud", broker=args.broker, backend=args.backend)
+    result = app.send_task("yolocloud.tasks.bulk_power_action",
+            kwargs=dict(action=args.action, uuids=args.uuids or None,
+                libvirt_url=args.libvirt_url))
+    if not args.wait:
+        print(result.id)
+        return
+    for uuid, status in sorted(result.get().items()):
+        print(uuid, status)
+
+def main_host_queue(args):
+    print(" ".join(routing.HostRouter().worker_arguments(args.libvirt_url)))
+
+def main_rebuild_counters(args):
+    # Needed once for databases whose failed machines were still counted
+    # as being provisioned
+    session = Session()
+    database.rebuild_fleet_counters(session)
+    for (libvirt_url, state), count in sorted(database.fleet_counts(session).items()):
+        print(libvirt_url, state, count)
 
 def main(argv):
     argparser = argparse.ArgumentParser(description="YoloCloud CLI tool")
@@ -33,12 +116,17 @@ def main(argv):
             help="Database engine URI")
     argparser.add_argument("--broker", default="pyamqp://", dest="broker",
             help="Celery broker URI")
+    argparser.add_argument("--backend", default=None, dest="backend",
+            help="Celery result backend URI")
 
     subparsers = argparser.add_subparsers(dest="command")
 
     argparser_create_token = subparsers.add_parser("create-token")
     argparser_create_domain = subparsers.add_parser("create-domain")
     argparser_delete_domain = subparsers.add_parser("delete-domain")
+    argparser_power_action = subparsers.add_parser("power-action")
+    argparser_host_queue = subparsers.add_parser("host-queue")
+    subparsers.add_parser("rebuild-counters")
 
     argparser_create_token.add_argument("--vm-lifetime", type=int, default=0,
             dest="vm_lifetime", help="Lifetime for virtual machines in SI seconds")
@@ -46,6 +134,12 @@ def main(argv):
             dest="regenerate", help="If set, then the tokens won't expire on use")
     argparser_create_token.add_argument("--libvirt-url", type=str,
             dest="libvirt_url", help="Enforce libvirt URL for generated virtual machines")
+    argparser_create_token.add_argument("--count", type=int, default=1,
+            dest="count", help="Number of tokens to create")
+    argparser_create_token.add_argument("--valid-for", type=int, default=0,
+            dest="valid_for", help="Seconds until the tokens expire, 0 for never")
+    argparser_create_token.add_argument("--csv", type=str, default=None,
+            dest="csv", help="Write the tokens as CSV to this file, - for stdout")
     argparser_create_token.add_argument("token", nargs="?", type=str,
             default=None, help="Token string")
 
@@ -53,13 +147,34 @@ def main(argv):
             help="Domain template name")
     argparser_create_domain.add_argument("--provision", type=bool, default=True,
             dest="provision", help="If set, enqueue provisioning")
+    argparser_create_domain.add_argument("--count", type=int, default=1,
+            dest="count", help="Number of domains to create")
+    argparser_create_domain.add_argument("--libvirt-url", type=str,
+            action="append", dest="libvirt_urls",
+            help="libvirt URL to place domains on, may be given multiple times")
     
     argparser_delete_domain.add_argument("--keep-hdd", type=bool, default=False,
             dest="keep_hdd", help="If set, then the HDDs won't get deleted.")
+    argparser_delete_domain.add_argument("uuids", nargs="+", type=str,
+            help="Domain UUIDs")
+
+    argparser_power_action.add_argument("action", type=str,
+            choices=("start", "shutdown", "reboot", "reset", "force-shutdown"),
+            help="Power action")
+    argparser_power_action.add_argument("uuids", nargs="*", type=str,
+            help="Domain UUIDs")
+    argparser_power_action.add_argument("--libvirt-url", type=str,
+            default=None, dest="libvirt_url",
+            help="Apply the action to all domains on this libvirt URL")
+    argparser_power_action.add_argument("--wait", action="store_true",
+            dest="wait", help="Wait for and print the per-domain results")
+
+    argparser_host_queue.add_argument("libvirt_url", type=str,
+            help="Print the Celery worker arguments for this libvirt URL")
 
     args = argparser.parse_args(argv)
 
-    engine = sqlalchemy.create_engine(args.engine)
+    engine = database.create_engine(args.engine)
     Session.configure(bind=engine)
 
     if args.command == "create-token":
@@ -68,8 +183,13 @@ def main(argv):
         main_create_domain(args)
     elif args.command == "delete-domain":
         main_delete_domain(args)
+    elif args.command == "power-action":
+        main_power_action(args)
+    elif args.command == "host-queue":
+        main_host_queue(args)
+    elif args.command == "rebuild-counters":
+        main_rebuild_counters(args)
 
 if __name__ == "__main__":
-    import sys
     main(sys.argv[1:])
 
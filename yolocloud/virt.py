@@ -1,73 +1,279 @@
 # coding: utf-8
 
+import collections
+import contextlib
+import hashlib
+import threading
+import time
+
 import libvirt
 import lxml.etree
 import urllib.parse
 import jinja2
 
+import yolocloud.instrumentation as instrumentation
+import yolocloud.templating as templating
+
+class ConnectionPool(object):
+    def __init__(self, max_idle=300, opener=None):
+        self.max_idle = max_idle
+        self.opener = opener or libvirt.open
+        self._connections = {}
+        self._borrowed = {}
+        self._last_used = {}
+        self._connect_locks = {}
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def connection(self, url):
+        vir_conn = self.acquire(url)
+        try:
+            yield vir_conn
+        except libvirt.libvirtError:
+            # The operation may have failed because the hypervisor went away,
+            # so make sure that the next borrower does not get a dead
+            # connection
+            if not self._is_alive(vir_conn):
+                self.discard(url, vir_conn)
+            raise
+        finally:
+            self.release(url, vir_conn)
+
+    def acquire(self, url):
+        with self._lock:
+            self.evict_idle()
+            vir_conn = self._checkout(url)
+            if vir_conn is not None:
+                return vir_conn
+            connect_lock = self._connect_locks.setdefault(url, threading.Lock())
+        # The handshake may take long for remote hosts, so only borrowers of
+        # the same host wait for it
+        with connect_lock:
+            with self._lock:
+                vir_conn = self._checkout(url)
+                if vir_conn is not None:
+                    return vir_conn
+            with instrumentation.libvirt_connect_seconds.time(url=url):
+                vir_conn = self.opener(url)
+            with self._lock:
+                self._connections[url] = vir_conn
+                self._borrowed[url] = self._borrowed.get(url, 0) + 1
+                self._last_used[url] = time.monotonic()
+                return vir_conn
+
+    def _checkout(self, url):
+        vir_conn = self._connections.get(url)
+        if vir_conn is not None and not self._is_alive(vir_conn):
+            self.discard(url, vir_conn)
+            vir_conn = None
+        if vir_conn is not None:
+            self._borrowed[url] = self._borrowed.get(url, 0) + 1
+            self._last_used[url] = time.monotonic()
+        return vir_conn
+
+    def release(self, url, vir_conn):
+        with self._lock:
+            if url in self._borrowed:
+                self._borrowed[url] -= 1
+                if not self._borrowed[url]:
+                    del self._borrowed[url]
+            self._last_used[url] = time.monotonic()
+
+    def discard(self, url, vir_conn):
+        with self._lock:
+            if self._connections.get(url) is vir_conn:
+                del self._connections[url]
+            self._last_used.pop(url, None)
+        try:
+            vir_conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            for url, vir_conn in list(self._connections.items()):
+                if url in self._borrowed:
+                    continue
+                if now - self._last_used.get(url, now) > self.max_idle:
+                    self.discard(url, vir_conn)
+
+    def close(self):
+        with self._lock:
+            for url, vir_conn in list(self._connections.items()):
+                self.discard(url, vir_conn)
+            self._borrowed.clear()
+
+    def reset(self):
+        # After a fork the inherited connections share their sockets with
+        # the parent, so they are forgotten instead of being closed
+        with self._lock:
+            self._connections = {}
+            self._borrowed = {}
+            self._last_used = {}
+            self._connect_locks = {}
+
+    @staticmethod
+    def _is_alive(vir_conn):
+        try:
+            return vir_conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+memory_units = {
+    "KiB": 1024,
+    "MiB": 1024 * 1024,
+    "GiB": 1024 * 1024 * 1024,
+    "KB": 1000,
+    "MB": 1000 * 1000,
+    "GB": 1000 * 1000 * 1000
+}
+
+class DomainSummary(object):
+    __slots__ = ("memory_bytes", "vcpus", "features", "vnc_port", "spice_port",
+            "cdrom", "has_cdrom", "disks")
+
+    # A single expression which yields every node any of the summary fields
+    # depends on, so the document is only walked once
+    _xpath_nodes = lxml.etree.XPath(
+            "memory | vcpu | features/* | devices/graphics | devices/disk")
+
+    _cache = collections.OrderedDict()
+    _cache_size = 1024
+    _cache_lock = threading.Lock()
+
+    def __init__(self, xml):
+        self.memory_bytes = None
+        self.vcpus = None
+        self.vnc_port = None
+        self.spice_port = None
+        self.cdrom = None
+        self.has_cdrom = False
+        features = []
+        disks = []
+        for node in self._xpath_nodes(xml):
+            if node.getparent() is not xml:
+                if node.tag == "graphics":
+                    self._graphics_node(node)
+                elif node.tag == "disk":
+                    self._disk_node(node, disks)
+                else:
+                    features.append(node.tag)
+            elif node.tag == "memory":
+                self.memory_bytes = int(node.text) * memory_units[
+                        node.get("unit", "KiB")]
+            elif node.tag == "vcpu":
+                self.vcpus = int(node.text)
+        self.features = tuple(features)
+        self.disks = tuple(disks)
+
+    def _graphics_node(self, node):
+        if not node.get("port"):
+            return
+        if node.get("type") == "vnc" and self.vnc_port is None:
+            self.vnc_port = int(node.get("port"))
+        elif node.get("type") == "spice" and self.spice_port is None:
+            self.spice_port = int(node.get("port"))
+
+    def _disk_node(self, node, disks):
+        src_node = node.find("source")
+        if node.get("device") == "disk":
+            if src_node is not None and src_node.get("pool"):
+                disks.append((src_node.get("pool"), src_node.get("volume")))
+            return
+        if node.get("device") != "cdrom" or self.has_cdrom:
+            return
+        self.has_cdrom = True
+        if src_node is not None:
+            self.cdrom = (src_node.get("pool"), src_node.get("volume"))
+
+    @classmethod
+    def from_xml_desc(cls, xml_desc, xml=None):
+        key = hashlib.sha1(xml_desc.encode()).digest()
+        with cls._cache_lock:
+            summary = cls._cache.get(key)
+            if summary is not None:
+                cls._cache.move_to_end(key)
+                return summary
+        if xml is None:
+            xml = lxml.etree.fromstring(xml_desc)
+        summary = cls(xml)
+        with cls._cache_lock:
+            cls._cache[key] = summary
+            if len(cls._cache) > cls._cache_size:
+                cls._cache.popitem(last=False)
+        return summary
+
 class DomainDescription(object):
     _xml = None
-    def __init__(self, domain):
+    _summary = None
+    _modified = False
+    _xpath_cdrom = lxml.etree.XPath("devices/disk[@device='cdrom']")
+
+    def __init__(self, domain, xml_desc=None):
         self.domain = domain
+        self._xml_desc = xml_desc
+
+    @property
+    def xml_desc(self):
+        if self._xml_desc is None:
+            self._xml_desc = self.domain.XMLDesc()
+        return self._xml_desc
 
     @property
     def xml(self):
         if self._xml is None:
-            self._xml = lxml.etree.fromstring(self.domain.XMLDesc())
+            self._xml = lxml.etree.fromstring(self.xml_desc)
         return self._xml
 
+    @property
+    def summary(self):
+        if self._summary is None and self._modified:
+            self._summary = DomainSummary(self.xml)
+        elif self._summary is None:
+            self._summary = DomainSummary.from_xml_desc(self.xml_desc,
+                    xml=self._xml)
+        return self._summary
+
     def flush_cache(self):
         self._xml = None
+        self._summary = None
+        self._modified = False
+        if self.domain is not None:
+            self._xml_desc = None
 
     @property
     def memory(self):
         return self.memory_in(1024 * 1024)
 
     def memory_in(self, multiplier):
-        node = self.xml.find("./memory")
-        unit = node.get("unit")
-        value = node.text
-        mult = {
-            "KiB": 1024,
-            "MiB": 1024 * 1024,
-            "GiB": 1024 * 1024 * 1024,
-            "KB": 1000,
-            "MB": 1000 * 1000,
-            "GB": 1000 * 1000 * 1000
-        }[unit]/multiplier
-
-        return int(value)*mult
+        return self.summary.memory_bytes / multiplier
 
     @property
     def vcpus(self):
-        return int(self.xml.find("./vcpu").text)
+        return self.summary.vcpus
 
     def features(self):
-        return (node.tag for node in self.xml.findall("./features/*"))
+        return iter(self.summary.features)
     
     @property
     def vnc_port(self):
-        node = self.xml.find("./devices/graphics[@type='vnc']")
-        if node is None or not node.get("port"):
-            return None
-        return int(node.get("port"))
+        return self.summary.vnc_port
     
     @property
     def spice_port(self):
-        node = self.xml.find("./devices/graphics[@type='spice']")
-        if node is None or not node.get("port"):
-            return None
-        return int(node.get("port"))
+        return self.summary.spice_port
     
     def remote_management_uri(self, host=None):
+        summary = self.summary
         url_scheme = None
         port = None
-        if self.spice_port:
+        if summary.spice_port:
             url_scheme = "spice"
-            port = self.spice_port
-        elif self.vnc_port:
+            port = summary.spice_port
+        elif summary.vnc_port:
             url_scheme = "vnc"
-            port = self.vnc_port
+            port = summary.vnc_port
         if url_scheme is None:
             return None
         if ":" in host:
@@ -77,20 +283,16 @@ class DomainDescription(object):
 
     @property
     def cdrom(self):
-        node = self.xml.find("./devices/disk[@device='cdrom']")
-        if node is None:
-            return None
-        node = node.find("./source")
-        if node is None:
-            return None
-        return (node.get("pool"), node.get("volume"))
+        return self.summary.cdrom
 
     @cdrom.setter
     def cdrom(self, new_medium):
         pool, vol = new_medium
         n = self.cdrom_node
-        if not n:
+        if n is None:
             return
+        self._summary = None
+        self._modified = True
         src_node = n.find("./source")
         if src_node is None:
             element = lxml.etree.SubElement(n, "source")
@@ -115,31 +317,134 @@ class DomainDescription(object):
     
     @property
     def has_cdrom(self):
-        return self.xml.find("./devices/disk[@device='cdrom']") is not None
+        return self.summary.has_cdrom
+
+    @property
+    def disks(self):
+        return self.summary.disks
 
     @property
     def cdrom_node(self):
-        return self.xml.find("./devices/disk[@device='cdrom']")
+        nodes = self._xpath_cdrom(self.xml)
+        return nodes[0] if nodes else None
 
     def dump(self):
         return lxml.etree.dump(self.xml)
 
+# Disks with a snapshot are overlays named after their frozen base volume
+overlay_suffix = "-overlay"
+
 class VirtualMachineTemplate(object):
-    def __init__(self, loader=None):
+    snapshot_name = "clean"
+    _xpath_disk_sources = lxml.etree.XPath(
+            "devices/disk[@device='disk']/source[@pool]")
+
+    def __init__(self, loader=None, snapshot=None):
         if loader is None:
-            loader = jinja2.PackageLoader("yolocloud", "templates")
-        self.jinja2_env = jinja2.Environment(loader=loader)
+            self.jinja2_env = templating.environment("templates")
+        else:
+            self.jinja2_env = jinja2.Environment(loader=loader)
+        # Snapshot taken after provisioning: None, "disk" for copy-on-write
+        # overlays on top of the disks or "full" for a libvirt snapshot,
+        # which includes the memory of running machines
+        self.snapshot = snapshot
 
     def render_template(self, name, *args, **kwargs):
         return self.jinja2_env.get_template(name).render(*args, **kwargs)
 
-    def provision(self, vm, vir_conn):
+    def preload(self):
+        templating.precompile(self.jinja2_env)
+
+    @contextlib.contextmanager
+    def phase(self, name, percent, progress=None):
+        if progress is not None:
+            progress(name, percent)
+        with instrumentation.provision_phase_seconds.time(phase=name):
+            yield
+
+    def provision(self, vm, vir_conn, progress=None):
         pass
 
+    def take_snapshot(self, vm, vir_conn, mode=None):
+        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+        if (mode or self.snapshot or "disk") == "full":
+            self._take_full_snapshot(vir_dom)
+        else:
+            self._take_disk_snapshot(vir_conn, vir_dom)
+
+    def _take_full_snapshot(self, vir_dom):
+        try:
+            vir_dom.snapshotLookupByName(self.snapshot_name).delete()
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+                raise
+        vir_dom.snapshotCreateXML(
+                "<domainsnapshot><name>{}</name></domainsnapshot>".format(
+                    self.snapshot_name))
+
+    def _take_disk_snapshot(self, vir_conn, vir_dom):
+        # The running qemu can't be moved onto a new disk, but while the
+        # domain is shut off the overlays are created instantly
+        if vir_dom.isActive():
+            raise ValueError("Disk snapshots need a domain which is shut off")
+        # Without the secure description the graphics passwords would get
+        # lost when the domain is redefined
+        dom_desc = DomainDescription(vir_dom, vir_dom.XMLDesc(
+            libvirt.VIR_DOMAIN_XML_INACTIVE | libvirt.VIR_DOMAIN_XML_SECURE))
+        for node in self._xpath_disk_sources(dom_desc.xml):
+            volume = node.get("volume")
+            if volume.endswith(overlay_suffix):
+                raise ValueError("Domain already has a disk snapshot")
+            pool = vir_conn.storagePoolLookupByName(node.get("pool"))
+            self._create_overlay(pool, pool.storageVolLookupByName(volume),
+                    volume + overlay_suffix)
+            node.set("volume", volume + overlay_suffix)
+        vir_conn.defineXML(lxml.etree.tostring(dom_desc.xml).decode())
+
+    def _create_overlay(self, pool, base_vol, volume):
+        base_format = lxml.etree.fromstring(base_vol.XMLDesc()).find(
+                "target/format")
+        pool.createXML(self.render_template("snapshot/overlay.xml",
+            volume=volume, capacity=base_vol.info()[1],
+            backing_store=dict(path=base_vol.path(),
+                format=base_format.get("type") if base_format is not None
+                    else "raw")))
+
+    def revert_snapshot(self, vm, vir_conn):
+        vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
+        try:
+            snapshot = vir_dom.snapshotLookupByName(self.snapshot_name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+                raise
+        else:
+            vir_dom.revertToSnapshot(snapshot)
+            return True
+        overlays = [(pool, volume) for pool, volume
+                in DomainDescription(vir_dom).disks
+                if volume.endswith(overlay_suffix)]
+        if not overlays:
+            return False
+        # Throwing the overlays away and starting over with empty ones
+        # restores the frozen state without copying a single block
+        active = vir_dom.isActive()
+        if active:
+            vir_dom.destroy()
+        for pool_name, volume in overlays:
+            pool = vir_conn.storagePoolLookupByName(pool_name)
+            pool.storageVolLookupByName(volume).delete()
+            self._create_overlay(pool, pool.storageVolLookupByName(
+                volume[:-len(overlay_suffix)]), volume)
+        if active:
+            vir_dom.create()
+        return True
+
 class BaseVMTemplate(VirtualMachineTemplate):
     def __init__(self, memory=1024, hdd=1024*10, network_bridge="virbr1",
-            network_type="e1000", with_network=True, with_cdrom=True, cpus=1):
-        VirtualMachineTemplate.__init__(self)
+            network_type="e1000", with_network=True, with_cdrom=True, cpus=1,
+            storage_pool="default", base_image=None, base_pool="default",
+            base_format="qcow2", domain_type="kvm", snapshot=None):
+        VirtualMachineTemplate.__init__(self, snapshot=snapshot)
         self.memory = memory
         self.cpus = cpus
         self.hdd = hdd
@@ -147,21 +452,49 @@ class BaseVMTemplate(VirtualMachineTemplate):
         self.network_type = network_type
         self.with_network = with_network
         self.with_cdrom = with_cdrom
+        self.storage_pool = storage_pool
+        # Name of a golden image volume in base_pool; if set, new machines get
+        # a copy-on-write overlay on top of it instead of a blank disk
+        self.base_image = base_image
+        self.base_pool = base_pool
+        self.base_format = base_format
+        self.domain_type = domain_type
 
-    def provision(self, vm, vir_conn):
-        domain_xml = self.render_template("base/domain.xml", memory=self.memory,
-                cpus=self.cpus, hdd=self.hdd, network_bridge=self.network_bridge,
+    def _template_args(self, vm, **kwargs):
+        return dict(memory=self.memory, cpus=self.cpus, hdd=self.hdd,
+                network_bridge=self.network_bridge,
                 network_type=self.network_type, with_network=self.with_network,
-                with_cdrom=self.with_cdrom, vm=vm)
-        volume_xml = self.render_template("base/volume.xml", memory=self.memory,
-                cpus=self.cpus, hdd=self.hdd, network_bridge=self.network_bridge,
-                network_type=self.network_type, with_network=self.with_network,
-                with_cdrom=self.with_cdrom, vm=vm)
-        vir_conn.defineXML(domain_xml)
-        default_pool = vir_conn.storagePoolLookupByName("default")
-        default_pool.createXML(volume_xml)
+                with_cdrom=self.with_cdrom, storage_pool=self.storage_pool,
+                domain_type=self.domain_type, vm=vm, **kwargs)
+
+    def _backing_store(self, vir_conn):
+        if self.base_image is None:
+            return None, self.hdd * 1024 * 1024
+        base_vol = vir_conn.storagePoolLookupByName(
+                self.base_pool).storageVolLookupByName(self.base_image)
+        # An overlay can't be smaller than its backing image
+        capacity = max(self.hdd * 1024 * 1024, base_vol.info()[1])
+        return dict(path=base_vol.path(), format=self.base_format), capacity
+
+    def provision(self, vm, vir_conn, progress=None):
+        with self.phase("lookup_base_image", 10, progress):
+            backing_store, capacity = self._backing_store(vir_conn)
+        with self.phase("render", 20, progress):
+            domain_xml = self.render_template("base/domain.xml",
+                    **self._template_args(vm))
+            volume_xml = self.render_template("base/volume.xml",
+                    **self._template_args(vm, capacity=capacity,
+                        backing_store=backing_store))
+        with self.phase("define", 40, progress):
+            vir_conn.defineXML(domain_xml)
+        with self.phase("create_volume", 70, progress):
+            pool = vir_conn.storagePoolLookupByName(self.storage_pool)
+            pool.createXML(volume_xml)
     
     def __str__(self):
+        if self.base_image is not None:
+            return "{} ({} MB RAM, {} GB HDD, {} CPUs)".format(
+                    self.base_image, self.memory, self.hdd, self.cpus)
         return "Barebone image ({} MB RAM, {} GB HDD, {} CPUs)".format(
                 self.memory, self.hdd, self.cpus)
 
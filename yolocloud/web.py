@@ -1,40 +1,72 @@
 # coding: utf-8
 
+import collections
+import concurrent.futures
 import datetime
-import random
 import functools
+import hashlib
+import json
+import math
+import threading
+import time
 
 import bottle
 import libvirt
 import jinja2
 
+import yolocloud.admission as admission
+import yolocloud.cache as cache
 import yolocloud.database as database
+import yolocloud.events as events
+import yolocloud.executors as executors
+import yolocloud.instrumentation as instrumentation
+import yolocloud.routing as routing
+import yolocloud.scheduler as scheduler
+import yolocloud.stats as stats
+import yolocloud.templating as templating
 import yolocloud.virt as virt
 
+class RequestError(Exception):
+    def __init__(self, status, reason, retry_after=None):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
 class Jinja2Mixin(object):
-    def __init__(self, *args, loader=None, **kwargs):
+    def __init__(self, *args, loader=None, template_path="views", **kwargs):
         if loader is None:
-            loader = jinja2.PackageLoader("yolocloud", "views")
-        self._jinja2_env = jinja2.Environment(loader=loader)
+            self._jinja2_env = templating.environment(template_path)
+        else:
+            self._jinja2_env = jinja2.Environment(loader=loader)
+        self._jinja2_cache = templating.RenderCache(self._jinja2_env)
         # implement the _render_view protocol
         self._render_view = self._render_jinja2
 
     def _render_jinja2(self, name, *args, **kwargs):
         return self._jinja2_env.get_template(name).render(*args, **kwargs)
 
+    def _render_jinja2_cached(self, name, key=None, **kwargs):
+        return self._jinja2_cache.render(name, key, **kwargs)
+
+    def _preload_jinja2(self):
+        templating.precompile(self._jinja2_env)
+
     @staticmethod
-    def with_jinja2_renderer(f, template=None):
+    def with_jinja2_renderer(f, template=None, cached=False):
         if isinstance(f, str):
-            return lambda g: Jinja2Mixin.with_jinja2_renderer(g, template=f)
+            return lambda g: Jinja2Mixin.with_jinja2_renderer(g, template=f,
+                    cached=cached)
         if template is None:
             template = f.__name__
+        render = "_render_jinja2_cached" if cached else "_render_jinja2"
         @functools.wraps(f)
         def wrapper(self, *args, **kwds):
             res = f(self, *args, **kwds)
             if isinstance(res, dict):
-                return self._render_jinja2(template, **res)
+                return getattr(self, render)(template, **res)
             elif res is None:
-                return self._render_jinja2(template)
+                return getattr(self, render)(template)
             return res
         return wrapper
 
@@ -43,7 +75,8 @@ class DatabaseMixin(object):
         import sqlalchemy
         import sqlalchemy.orm
         if isinstance(engine, str):
-            engine = sqlalchemy.create_engine(engine)
+            engine = database.create_engine(engine)
+        self._engine = engine
         self._Session = sqlalchemy.orm.sessionmaker(bind=engine)
 
     @staticmethod
@@ -58,24 +91,48 @@ class DatabaseMixin(object):
         return wrapper
 
 class CeleryMixin(object):
-    def __init__(self, *args, celery_app=None, **kwargs):
+    def __init__(self, *args, celery_app=None, host_router=None, **kwargs):
         if celery_app is None:
             import celery
             celery_app = celery.Celery("yolocloud", broker="pyamqp://")
         self.celery_app = celery_app
+        self.host_router = host_router or routing.HostRouter()
 
     @staticmethod
     def task(f):
         if isinstance(f, str):
             def wrapper(self, *args, **kwargs):
-                self.queue_task(f, *args, **kwargs)
+                return self.queue_task(f, *args, **kwargs)
             return wrapper
         return f
+
+    def task_libvirt_url(self, task, kwargs):
+        return kwargs.get("libvirt_url")
+
+    def task_options(self, task, kwargs):
+        # Tasks go to the queue of the host they operate on, so a stalled
+        # hypervisor only blocks the workers dedicated to it
+        return self.host_router.options(self.task_libvirt_url(task, kwargs),
+                task=task)
     
     def queue_task(self, task, *args, **kwargs):
         if self.celery_app is False:
             return
-        self.celery_app.send_task(task, args=args, kwargs=kwargs)
+        if self.celery_app.conf.task_always_eager:
+            return self.celery_app.tasks[task].apply(args=args, kwargs=kwargs)
+        # The send time lets workers measure how long tasks were queued
+        return self.celery_app.send_task(task, args=args, kwargs=kwargs,
+                headers=dict(sent_at=time.time()),
+                **self.task_options(task, kwargs))
+
+    def queue_group(self, task, kwargs_list):
+        if self.celery_app is False:
+            return
+        import celery
+        headers = dict(sent_at=time.time())
+        celery.group(self.celery_app.signature(task, kwargs=kwargs,
+            headers=headers, **self.task_options(task, kwargs))
+            for kwargs in kwargs_list).apply_async()
 
     def send_task(self, task, *args, **kwargs):
         if self.celery_app is False:
@@ -110,10 +167,20 @@ class VMController(BaseApplication, Jinja2Mixin, DatabaseMixin, CeleryMixin):
     reset_vm = CeleryMixin.task("yolocloud.tasks.reset_vm")
     destroy_vm = CeleryMixin.task("yolocloud.tasks.destroy_vm")
     change_media = CeleryMixin.task("yolocloud.tasks.change_media")
+    bulk_power_action = CeleryMixin.task("yolocloud.tasks.bulk_power_action")
+    run_vm_actions = CeleryMixin.task("yolocloud.tasks.run_vm_actions")
+    teardown_vm = CeleryMixin.task("yolocloud.tasks.delete_vm")
 
-    def __init__(self, *args, vm_hosts=None, require_token=False, vm_templates=None, **kwargs):
+    power_actions = ("start", "shutdown", "reboot", "reset", "force-shutdown")
+
+    def __init__(self, *args, vm_hosts=None, require_token=False, vm_templates=None,
+            connections=None, domain_cache=None, media_catalogue=None,
+            host_scheduler=None, placement_policy="least-loaded",
+            stats_collector=None, admin_token=None, host_executors=None,
+            admission_control=None, trusted_proxies=0, max_event_streams=4,
+            **kwargs):
         BaseApplication.__init__(self, *args, **kwargs)
-        Jinja2Mixin.__init__(self, loader=jinja2.PackageLoader("yolocloud", "views/vm"))
+        Jinja2Mixin.__init__(self, template_path="views/vm")
         DatabaseMixin.__init__(self, *args, **kwargs)
         CeleryMixin.__init__(self, *args, **kwargs)
         self.vm_hosts = vm_hosts or {"qemu:///system": "::"}
@@ -121,131 +188,639 @@ class VMController(BaseApplication, Jinja2Mixin, DatabaseMixin, CeleryMixin):
             "base": virt.BaseVMTemplate()
         }
         self.require_token = require_token
+        # Listing all machines reveals their UUIDs, which double as access
+        # credentials, so it is only possible with this token
+        self.admin_token = admin_token
+        self.max_bulk_count = 500
+        self._libvirt_urls = collections.OrderedDict()
+        self._libvirt_urls_lock = threading.Lock()
         self.media_pool = "iso"
+        self.connections = connections or virt.ConnectionPool()
+        self.host_executors = host_executors or executors.HostExecutors()
+        self.domain_cache = domain_cache or cache.DomainStateCache()
+        self.media_catalogue = media_catalogue or cache.MediaCatalogue(
+                connections=self.connections)
+        self.host_scheduler = host_scheduler or scheduler.HostScheduler(
+                self.vm_hosts, connections=self.connections,
+                policy=placement_policy, host_executors=self.host_executors)
+        self.stats_collector = stats_collector or stats.StatsCollector(
+                self.vm_hosts, connections=self.connections,
+                host_executors=self.host_executors)
+        self.progress = events.ProgressBroadcaster(self._Session,
+                domain_cache=self.domain_cache)
+        self.event_stream_timeout = 300
+        # Every stream holds a request thread for its whole lifetime, so
+        # only a few of them may be open at once in each process
+        self._event_stream_slots = threading.BoundedSemaphore(max_event_streams)
+        self.admission = admission_control or admission.AdmissionControl()
+        self.provisioning_retry_after = 30
+        self.token_cache = cache.TokenCache()
+        # Number of reverse proxies in front of us which append to
+        # X-Forwarded-For; anything further left was sent by the client and
+        # can't be trusted for rate limiting
+        self.trusted_proxies = trusted_proxies
 
         self.route("/<uuid>", "GET", self.show_vm)
         self.route("/<uuid>", "POST", self.update_vm)
+        self.route("/<uuid>/events", "GET", self.show_vm_events)
         self.route("/<uuid>/delete", "POST", self.delete_vm)
         self.route("/<uuid>", "DELETE", self.delete_vm)
+        self.route("/bulk", "POST", self.create_vms)
+        self.route("/bulk/actions", "POST", self.update_vms)
+        self.route("/bulk/actions/<task_id>", "GET", self.show_bulk_action)
         self.route("/stats", "GET", self.show_stats)
+        self.route("/stats.json", "GET", self.show_stats_json)
         self.route("/", "GET", self.index_page)
         self.route("/", "POST", self.create_vm)
+        self.route("/metrics", "GET", self.show_metrics)
+        self.route("/api/vms", "GET", self.api_list_vms)
+        self.route("/api/vms", "POST", self.api_create_vm)
+        self.route("/api/vms/<uuid>", "GET", self.api_show_vm)
+        self.route("/api/vms/<uuid>/state", "GET", self.api_show_vm_state)
+        self.route("/api/vms/<uuid>/actions", "POST", self.api_update_vm)
+        self.install(instrumentation.BottlePlugin(
+            instrumentation.request_seconds))
+
+    def preload(self):
+        # Everything loaded here before the server forks is shared
+        # copy-on-write between its workers
+        self._preload_jinja2()
+        for vm_template in self.vm_templates.values():
+            vm_template.preload()
+
+    def after_fork(self):
+        # Sockets inherited from the parent must not be used by the child,
+        # and none of the background threads survive the fork anyway
+        self._engine.dispose(close=False)
+        self.connections.reset()
+        self.host_executors.reset()
+        self.domain_cache.reset()
+        self.media_catalogue.reset()
+        self.stats_collector.reset()
+        self.progress.reset()
+        self.token_cache.clear()
+        self.celery_app._after_fork()
+        for url in self.vm_hosts:
+            self.host_executors.submit(url, self._warm_up_host, url)
+
+    def _warm_up_host(self, url):
+        try:
+            with self.connections.connection(url):
+                pass
+        except libvirt.libvirtError:
+            return
+        self.domain_cache.watch(url)
 
-    @Jinja2Mixin.with_jinja2_renderer("index.html")
     def index_page(self):
         if "manage" in self.request.query and self.request.query.get("uuid"):
             bottle.redirect("/{}".format(self.request.query["uuid"]))
-        return dict(vm_templates=self.vm_templates)
+        # The templates on offer don't change while we are running, so the
+        # page is rendered only once
+        return self._render_jinja2_cached("index.html", key="index.html",
+                vm_templates=self.vm_templates)
 
     @DatabaseMixin.with_database_session
     def create_vm(self, db):
-        vm = database.VirtualMachine()
-        template = self.request.forms["template"]
+        try:
+            self._admit(self.request.forms.get("token"))
+            vm, ready = self._create_vm(db, self.request.forms.get("template"),
+                    self.request.forms.get("token"))
+        except RequestError as e:
+            return self.report_error(e)
+        bottle.redirect("/{}".format(vm.uuid))
+
+    def _client_address(self):
+        route = [address.strip() for address in self.request.environ.get(
+            "HTTP_X_FORWARDED_FOR", "").split(",") if address.strip()] \
+                    if self.trusted_proxies else []
+        route.append(self.request.environ.get("REMOTE_ADDR"))
+        return route[max(len(route) - 1 - self.trusted_proxies, 0)]
+
+    def _admit(self, token_string):
+        # Checked before anything touches the database, so a flood of
+        # requests is turned away as cheaply as possible. The buckets count
+        # requests, a bulk creation costs as much as a single one.
+        if self._is_admin():
+            return
+        wait = self.admission.admit(self._client_address(), token_string)
+        if wait == math.inf:
+            raise RequestError(429, "Too many engines requested at once")
+        elif wait:
+            raise RequestError(429, "Too many engines requested, please retry later",
+                    retry_after=math.ceil(wait))
+
+    def _reserve_provisioning(self, db, count=1):
+        if self._is_admin():
+            return
+        if not self.admission.provisioning_slots(
+                database.provisioning_count(db), count):
+            db.rollback()
+            raise RequestError(429, "Too many engines are being set up right now",
+                    retry_after=self.provisioning_retry_after)
+
+    def _redeem_token(self, db, token_string):
+        if not token_string:
+            return None
+        token = self.token_cache.lookup(db, token_string)
+        if token is None or (token.expires_at is not None and
+                token.expires_at <= datetime.datetime.now()):
+            return None
+        if not token.regenerates:
+            # The delete is part of the transaction which creates the
+            # machine, so the token is given back if that fails
+            self.token_cache.invalidate(token_string)
+            if not database.consume_token(db, token_string):
+                return None
+        return token
+
+    def _create_vm(self, db, template, token_string):
         if template not in self.vm_templates:
-            return self.report_403("Forbidden template type")
-        token = db.query(database.Token).filter(
-                database.Token.token == self.request.forms["token"]).first()
+            raise RequestError(403, "Forbidden template type")
+        vm = database.VirtualMachine(template=template)
+        token = self._redeem_token(db, token_string)
         if token:
             if token.vm_lifetime:
                 vm.expires_at = datetime.datetime.now() + datetime.timedelta(seconds=token.vm_lifetime)
             if token.libvirt_url:
                 vm.libvirt_url = token.libvirt_url
-            if not token.regenerates:
-                db.delete(token)
         elif self.require_token:
-            return self.report_403("Engine creation not possible without token")
+            raise RequestError(403, "Engine creation not possible without token")
+        warm_vm = database.claim_warm_vm(db, template,
+                libvirt_url=vm.libvirt_url, expires_at=vm.expires_at)
+        if warm_vm is not None:
+            return warm_vm, True
+        self._reserve_provisioning(db)
         if not vm.libvirt_url:
-            vm.libvirt_url = self._pick_libvirt_host()
+            vm.libvirt_url = self._pick_libvirt_host(template)
+        if not vm.libvirt_url:
+            db.rollback()
+            raise RequestError(503, "No host has capacity left for this engine")
         try:
-            if token and not token.regenerates:
-                db.delete(token)
             db.add(vm)
             db.commit()
         except:
             db.rollback()
+            raise
+        self._remember_libvirt_url(vm.uuid, vm.libvirt_url)
         self.provision_vm(uuid=vm.uuid, template=template)
-        bottle.redirect("/{}".format(vm.uuid))
+        return vm, False
+
+    @DatabaseMixin.with_database_session
+    def create_vms(self, db):
+        template = self.request.forms.get("template")
+        if template not in self.vm_templates:
+            return self.report_403("Forbidden template type")
+        try:
+            count = int(self.request.forms.get("count", 1))
+        except ValueError:
+            count = 0
+        if not 0 < count <= self.max_bulk_count:
+            return self.report_400("Invalid engine count")
+        try:
+            self._admit(self.request.forms.get("token"))
+        except RequestError as e:
+            return self.report_error(e)
+        values = dict(template=template)
+        token = self._redeem_token(db, self.request.forms.get("token"))
+        if token:
+            if token.vm_lifetime:
+                values["expires_at"] = datetime.datetime.now() + datetime.timedelta(seconds=token.vm_lifetime)
+            if token.libvirt_url:
+                values["libvirt_url"] = token.libvirt_url
+        elif self.require_token:
+            return self.report_403("Engine creation not possible without token")
+        try:
+            self._reserve_provisioning(db, count)
+        except RequestError as e:
+            return self.report_error(e)
+        vms = []
+        for i in range(count):
+            vm = database.VirtualMachine(**values)
+            if not vm.libvirt_url:
+                # The scheduler accounts for each placement, so the batch
+                # gets spread over the hosts according to their capacity
+                vm.libvirt_url = self._pick_libvirt_host(template)
+            if not vm.libvirt_url:
+                db.rollback()
+                return self.report_503("No host has capacity left for these engines")
+            vms.append(vm)
+        try:
+            db.add_all(vms)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        for vm in vms:
+            self._remember_libvirt_url(vm.uuid, vm.libvirt_url)
+        self.queue_group("yolocloud.tasks.provision_vm",
+                [dict(uuid=vm.uuid, template=template) for vm in vms])
+        return dict(uuids=[vm.uuid for vm in vms])
 
     @DatabaseMixin.with_database_session
     @Jinja2Mixin.with_jinja2_renderer("show.html")
     def show_vm(self, uuid, db=None):
-        vm = db.query(database.VirtualMachine).filter(
-                database.VirtualMachine.uuid == uuid).first()
+        vm = database.lookup_vm(db, uuid)
         if vm is None:
             return self.report_404("Engine not found")
-        elif not vm.provisioned:
-            return self.report_202("Engine not ready")
-        vir_conn = libvirt.open(vm.libvirt_url)
-        vm_desc = None
-        vm_info = None
-        medias = []
+        if not vm.provisioned:
+            return self.report_202("Engine not ready", vm=vm)
         try:
-            vir_dom = vir_conn.lookupByUUIDString(vm.uuid)
-            vm_info = vir_dom.info()
-            vm_desc = virt.DomainDescription(vir_dom)
-
-            media_pool = vir_conn.storagePoolLookupByName(self.media_pool)
-            if media_pool:
-                medias = media_pool.listAllVolumes()
-        finally:
-            vir_conn.close()
+            vm_state = self._domain_state(vm)
+            medias = []
+            if vm_state.description.has_cdrom:
+                medias = self._media_volumes(vm.libvirt_url)
+        except RequestError as e:
+            return self.report_error(e)
         return dict(vm=vm,
-            vm_desc=vm_desc,
-            vm_state=virt.state_to_text_mapping.get(vm_info[0]),
-            vm_info=vm_info,
+            vm_desc=vm_state.description,
+            vm_state=virt.state_to_text_mapping.get(vm_state.info[0]),
+            vm_info=vm_state.info,
             vm_host=self.vm_hosts.get(vm.libvirt_url),
             medias=medias)
 
+    def _domain_state(self, vm):
+        vm_state = self.domain_cache.lookup(vm.libvirt_url, vm.uuid)
+        if vm_state is None:
+            # Live queries go through the bounded executor of the host, so a
+            # hanging hypervisor costs a timeout instead of a request thread
+            try:
+                vm_state = self.host_executors.call(vm.libvirt_url,
+                        self._fetch_domain_state, vm.libvirt_url, vm.uuid)
+            except concurrent.futures.TimeoutError:
+                raise RequestError(503, "Hypervisor not responding")
+        return vm_state
+
+    def _media_volumes(self, libvirt_url):
+        medias = self.media_catalogue.cached(libvirt_url, self.media_pool)
+        if medias is None:
+            try:
+                medias = self.host_executors.call(libvirt_url,
+                        self.media_catalogue.volumes, libvirt_url,
+                        self.media_pool)
+            except concurrent.futures.TimeoutError:
+                raise RequestError(503, "Hypervisor not responding")
+        return medias
+
+    def _fetch_domain_state(self, libvirt_url, uuid):
+        with self.connections.connection(libvirt_url) as vir_conn:
+            vir_dom = vir_conn.lookupByUUIDString(uuid)
+            return self.domain_cache.store(libvirt_url, uuid, vir_dom.info(),
+                    vir_dom.XMLDesc())
+
+    @DatabaseMixin.with_database_session
+    def show_vm_events(self, uuid, db=None):
+        vm = database.lookup_vm(db, uuid)
+        if vm is None:
+            return self.report_404("Engine not found")
+        if not self._event_stream_slots.acquire(blocking=False):
+            return self.report_error(RequestError(429,
+                "Too many progress streams open, please reload later",
+                retry_after=15))
+        self.response.content_type = "text/event-stream"
+        self.response.set_header("Cache-Control", "no-cache")
+        return self._vm_event_stream(uuid)
+
+    def _vm_event_stream(self, uuid):
+        # Streams end after a while, browsers reconnect on their own, so
+        # workers don't stay tied up by forgotten tabs. Once the machine is
+        # provisioned there is nothing left to report.
+        deadline = time.monotonic() + self.event_stream_timeout
+        state = None
+        try:
+            with self.progress.watch(uuid):
+                yield "retry: 2000\n\n"
+                while time.monotonic() < deadline:
+                    new_state = self.progress.wait(uuid, state, timeout=15)
+                    if new_state is None or new_state == state:
+                        yield ": keepalive\n\n"
+                        continue
+                    state = new_state
+                    yield "event: progress\ndata: {}\n\n".format(
+                            json.dumps(state._asdict()))
+                    if state.provisioned:
+                        break
+        finally:
+            self._event_stream_slots.release()
+
     @DatabaseMixin.with_database_session
     def update_vm(self, uuid, db=None):
-        vm = db.query(database.VirtualMachine).filter(
-                database.VirtualMachine.uuid == uuid).first()
-        action = self.request.forms.get("action")
-        if action == "shutdown":
-            self.shutdown_vm(uuid=vm.uuid)
-        elif action == "reboot":
-            self.reboot_vm(uuid=vm.uuid)
-        elif action == "start":
-            self.start_vm(uuid=vm.uuid)
-        elif action == "reset":
-            self.reset_vm(uuid=vm.uuid)
-        elif action == "force-shutdown":
-            self.destroy_vm(uuid=vm.uuid)
-        elif action == "change_media":
-            self.change_media(uuid=vm.uuid, media_pool=self.media_pool, media_volume=self.request.forms.get("image"))
+        vm = database.lookup_vm(db, uuid)
+        if vm is None:
+            return self.report_404("Engine not found")
+        try:
+            self._submit_vm_action(db, vm, self.request.forms.get("action"),
+                    self.request.forms.get("image"))
+        except RequestError as e:
+            return self.report_error(e)
         bottle.redirect("/{}".format(vm.uuid))
 
+    def _submit_vm_action(self, db, vm, action, image=None):
+        arguments = {}
+        if action == "change_media":
+            if image and not any(media.name == image
+                    for media in self._media_volumes(vm.libvirt_url)):
+                raise RequestError(404, "Media not found")
+            arguments = dict(media_pool=self.media_pool, media_volume=image)
+        elif action not in self.power_actions and action != "revert":
+            raise RequestError(403, "Unknown action")
+        # Actions are queued per machine, one worker runs them all instead
+        # of one task each
+        try:
+            queued = database.submit_vm_action(db, vm.uuid, action, arguments)
+        except ValueError:
+            raise RequestError(429, "Too many actions pending for this engine")
+        if queued:
+            self.run_vm_actions(uuid=vm.uuid)
+        return queued
+
+    def update_vms(self):
+        action = self.request.forms.get("action")
+        if action not in self.power_actions:
+            return self.report_403("Unknown action")
+        uuids = self.request.forms.getall("uuid") or None
+        host = self.request.forms.get("host") or None
+        if uuids is None and host is None:
+            return self.report_400("Neither engines nor host given")
+        if host is not None and not self._is_admin():
+            # Acting on every machine of a host is for administrators only
+            return self.report_403("Host wide actions not permitted")
+        if host is not None and host not in self.vm_hosts:
+            return self.report_404("Host not found")
+        result = self.bulk_power_action(action=action, uuids=uuids,
+                libvirt_url=host)
+        if result is None:
+            return dict(action=action, task=None)
+        return dict(action=action, task=result.id,
+                results="/bulk/actions/{}".format(result.id))
+
+    def show_bulk_action(self, task_id):
+        # The task ID is only known to whoever submitted the action, just
+        # like machine UUIDs; the report maps each machine to "ok", "queued"
+        # behind other actions, "not found" or the libvirt error
+        if self.celery_app is False:
+            return self._api_error(RequestError(404, "Task not found"))
+        import celery.backends.base
+        if isinstance(self.celery_app.backend, celery.backends.base.DisabledBackend):
+            return self._api_error(RequestError(503, "No result backend configured"))
+        result = self.celery_app.AsyncResult(task_id)
+        state = result.state
+        if state == "FAILURE":
+            return dict(task=task_id, state=state, error=str(result.result))
+        return dict(task=task_id, state=state,
+                results=result.result if state == "SUCCESS" else None)
+
     @DatabaseMixin.with_database_session
     def delete_vm(self, uuid, db=None):
-        vm = db.query(database.VirtualMachine).filter(
-                database.VirtualMachine.uuid == uuid).first()
+        vm = database.lookup_vm(db, uuid)
         if vm:
-            self.enqueue("delete_vm", uuid=vm.uuid)
+            # The machine is gone for the user at once, tearing it down is
+            # up to the workers
+            database.mark_deleted(db, [vm.uuid])
+            db.commit()
+            self.teardown_vm(uuid=vm.uuid)
         bottle.redirect("/")
 
     @DatabaseMixin.with_database_session
     @Jinja2Mixin.with_jinja2_renderer("stats.html")
     def show_stats(self, db=None):
-        vms = db.query(database.VirtualMachine).count()
-        return dict(vm_count=vms)
+        fleet = database.fleet_counts(db)
+        self.stats_collector.start()
+        # UUIDs grant access to their machines, so only admins get to see
+        # the statistics per machine
+        domain_stats = None
+        if self._is_admin():
+            domain_stats = sorted(self.stats_collector.overview().items())
+        return dict(vm_count=sum(fleet.values()),
+                fleet=sorted((self.vm_hosts.get(libvirt_url, libvirt_url),
+                    state, count) for (libvirt_url, state), count in fleet.items()),
+                host_stats=sorted((self.vm_hosts.get(libvirt_url, libvirt_url),
+                    rates) for libvirt_url, rates
+                    in self.stats_collector.host_overview().items()),
+                domain_stats=domain_stats)
+
+    def show_stats_json(self):
+        self.stats_collector.start()
+        uuids = self.request.query.getall("uuid") or None
+        # Everybody else only gets the series of machines they already know
+        if uuids is None and not self._is_admin():
+            return self._api_error(RequestError(403, "Listing engines not permitted"))
+        return self.stats_collector.as_dict(uuids)
+
+    def _is_admin(self):
+        return self.admin_token is not None and self.request.headers.get(
+                "Authorization") == "Bearer {}".format(self.admin_token)
+
+    api_fields = ("uuid", "template", "created_at", "expires_at", "host",
+            "provisioned", "provisioning_phase", "provisioning_progress",
+            "state")
+
+    def _api_input(self, name):
+        data = self.request.json
+        if isinstance(data, dict):
+            return data.get(name)
+        return self.request.forms.get(name)
+
+    def _api_error(self, error):
+        self.response.status = error.status
+        if error.retry_after is not None:
+            self.response.set_header("Retry-After", str(error.retry_after))
+        return dict(error=error.reason)
+
+    def _api_conditional(self, *parts):
+        # Clients which poll with If-None-Match get an empty 304 as long as
+        # nothing they could see has changed
+        etag = '"{}"'.format(hashlib.sha1(json.dumps(parts, default=str,
+            sort_keys=True).encode()).hexdigest())
+        self.response.set_header("ETag", etag)
+        if etag in self.request.headers.get("If-None-Match", ""):
+            raise bottle.HTTPResponse(status=304, headers={"ETag": etag})
 
-    def _pick_libvirt_host(self):
-        return random.choice(self.vm_hosts.keys())
+    def _api_vm(self, vm, fields=None, vm_state=None):
+        values = dict(uuid=vm.uuid,
+                template=vm.template,
+                created_at=vm.created_at.isoformat() if vm.created_at else None,
+                expires_at=vm.expires_at.isoformat() if vm.expires_at else None,
+                host=self.vm_hosts.get(vm.libvirt_url),
+                provisioned=bool(vm.provisioned),
+                provisioning_phase=vm.provisioning_phase,
+                provisioning_progress=vm.provisioning_progress or 0,
+                state=virt.state_to_text_mapping.get(vm_state.info[0])
+                    if vm_state is not None else None)
+        if fields is not None:
+            values = {field: values[field] for field in fields}
+        return values
+
+    @DatabaseMixin.with_database_session
+    def api_list_vms(self, db=None):
+        if not self._is_admin():
+            return self._api_error(RequestError(403, "Listing engines not permitted"))
+        try:
+            offset = max(int(self.request.query.get("offset", 0)), 0)
+            limit = min(max(int(self.request.query.get("limit", 50)), 1), 500)
+        except ValueError:
+            return self._api_error(RequestError(400, "Invalid pagination"))
+        fields = None
+        if self.request.query.get("fields"):
+            fields = self.request.query["fields"].split(",")
+            if not set(fields) <= set(self.api_fields):
+                return self._api_error(RequestError(400, "Unknown field"))
+        vms = db.query(database.VirtualMachine).filter(
+                database.VirtualMachine.deleted_at == None).order_by(
+                database.VirtualMachine.created_at,
+                database.VirtualMachine.uuid).offset(offset).limit(limit).all()
+        # Listings never wait for libvirt, the state is only reported for
+        # machines in the domain state cache
+        items = [self._api_vm(vm, fields,
+            self.domain_cache.lookup(vm.libvirt_url, vm.uuid)
+                if fields is None or "state" in fields else None)
+            for vm in vms]
+        self._api_conditional(offset, limit, items)
+        return dict(vms=items, offset=offset, limit=limit,
+                next_offset=offset + limit if len(items) == limit else None)
+
+    @DatabaseMixin.with_database_session
+    def api_show_vm(self, uuid, db=None):
+        vm = database.lookup_vm(db, uuid)
+        if vm is None:
+            return self._api_error(RequestError(404, "Engine not found"))
+        values = self._api_vm(vm)
+        vm_state = None
+        if vm.provisioned:
+            try:
+                vm_state = self._domain_state(vm)
+            except RequestError as e:
+                return self._api_error(e)
+            vm_desc = vm_state.description
+            values.update(self._api_vm(vm, ["state"], vm_state),
+                    memory=vm_desc.memory,
+                    vcpus=vm_desc.vcpus,
+                    cdrom=vm_desc.cdrom,
+                    remote_management_uri=vm_desc.remote_management_uri(
+                        self.vm_hosts.get(vm.libvirt_url)),
+                    management_password=vm.management_password)
+        self._api_conditional(values,
+                vm_state.info if vm_state is not None else None,
+                hashlib.sha1(vm_state.description.xml_desc.encode()).hexdigest()
+                    if vm_state is not None else None)
+        return values
 
-    @Jinja2Mixin.with_jinja2_renderer("404.html")
+    @DatabaseMixin.with_database_session
+    def api_show_vm_state(self, uuid, db=None):
+        vm = database.lookup_vm(db, uuid)
+        if vm is None:
+            return self._api_error(RequestError(404, "Engine not found"))
+        try:
+            vm_state = self._domain_state(vm) if vm.provisioned else None
+        except RequestError as e:
+            return self._api_error(e)
+        values = self._api_vm(vm, ["uuid", "provisioned", "provisioning_phase",
+            "provisioning_progress", "state"], vm_state)
+        self._api_conditional(values)
+        return values
+
+    @DatabaseMixin.with_database_session
+    def api_create_vm(self, db=None):
+        try:
+            self._admit(self._api_input("token"))
+            vm, ready = self._create_vm(db, self._api_input("template"),
+                    self._api_input("token"))
+        except RequestError as e:
+            return self._api_error(e)
+        location = "/api/vms/{}".format(vm.uuid)
+        self.response.status = 201 if ready else 202
+        self.response.set_header("Location", location)
+        return dict(uuid=vm.uuid, location=location, ready=ready)
+
+    @DatabaseMixin.with_database_session
+    def api_update_vm(self, uuid, db=None):
+        vm = database.lookup_vm(db, uuid)
+        if vm is None:
+            return self._api_error(RequestError(404, "Engine not found"))
+        action = self._api_input("action")
+        try:
+            self._submit_vm_action(db, vm, action, self._api_input("image"))
+        except RequestError as e:
+            return self._api_error(e)
+        self.response.status = 202
+        return dict(uuid=vm.uuid, action=action)
+
+    def task_libvirt_url(self, task, kwargs):
+        libvirt_url = CeleryMixin.task_libvirt_url(self, task, kwargs)
+        if libvirt_url is None and "uuid" in kwargs:
+            libvirt_url = self._libvirt_urls.get(kwargs["uuid"])
+            if libvirt_url is None:
+                libvirt_url = self._lookup_libvirt_url(kwargs["uuid"])
+            self._remember_libvirt_url(kwargs["uuid"], libvirt_url)
+        return libvirt_url
+
+    @DatabaseMixin.with_database_session
+    def _lookup_libvirt_url(self, uuid, db=None):
+        row = db.query(database.VirtualMachine.libvirt_url).filter(
+                database.VirtualMachine.uuid == uuid).first()
+        return row[0] if row else None
+
+    def _remember_libvirt_url(self, uuid, libvirt_url):
+        # Machines never move between hosts, so this never gets stale
+        if libvirt_url is None:
+            return
+        with self._libvirt_urls_lock:
+            self._libvirt_urls[uuid] = libvirt_url
+            self._libvirt_urls.move_to_end(uuid)
+            if len(self._libvirt_urls) > 10000:
+                self._libvirt_urls.popitem(last=False)
+
+    def show_metrics(self):
+        # Every server process only knows its own requests and answers for
+        # itself; with several workers a scrape sees whichever one accepted
+        # it, so run a single worker (with more threads) where complete
+        # metrics matter
+        self.response.content_type = instrumentation.content_type
+        return instrumentation.default_registry.expose()
+
+    def _pick_libvirt_host(self, template=None):
+        return self.host_scheduler.pick(self.vm_templates.get(template))
+
+    def report_error(self, error):
+        if error.retry_after is not None:
+            self.response.set_header("Retry-After", str(error.retry_after))
+        return getattr(self, "report_{}".format(error.status))(error.reason)
+
+    @Jinja2Mixin.with_jinja2_renderer("404.html", cached=True)
     def report_404(self, reason):
         self.response.status = 404
         return dict(reason=reason)
 
-    @Jinja2Mixin.with_jinja2_renderer("403.html")
+    @Jinja2Mixin.with_jinja2_renderer("400.html", cached=True)
+    def report_400(self, reason):
+        self.response.status = 400
+        return dict(reason=reason)
+
+    @Jinja2Mixin.with_jinja2_renderer("403.html", cached=True)
     def report_403(self, reason):
         self.response.status = 403
         return dict(reason=reason)
 
+    @Jinja2Mixin.with_jinja2_renderer("429.html", cached=True)
+    def report_429(self, reason):
+        self.response.status = 429
+        return dict(reason=reason)
+
+    @Jinja2Mixin.with_jinja2_renderer("503.html", cached=True)
+    def report_503(self, reason):
+        self.response.status = 503
+        return dict(reason=reason)
+
     @Jinja2Mixin.with_jinja2_renderer("202.html")
-    def report_202(self, reason):
+    def report_202(self, reason, vm=None):
         self.response.status = 202
-        return dict(reason=reason)
+        return dict(reason=reason, vm=vm)
 
-wsgi_app = VMController()
+def __getattr__(name):
+    # Building the controller creates a Celery app and a database engine,
+    # which should only happen once somebody actually serves it
+    global wsgi_app
+    if name == "wsgi_app":
+        wsgi_app = VMController()
+        return wsgi_app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 